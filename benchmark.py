@@ -0,0 +1,452 @@
+#!/usr/bin/env python3
+"""
+Benchmark the annotation filtering and conversion helpers on synthetic data.
+
+Builds Open Images style CSVs, Keylabs JSON folders and YOLO label
+directories at a chosen scale, times the public functions of utils.py,
+keylabs_to_yolo.py and generate_conditions.py, records their peak traced
+Python memory and their peak resident set size and writes the results to
+a JSON file. Runs fully offline.
+
+    python benchmark.py --scale 1m --output bench-1m.json
+    python benchmark.py --scale 1m --output bench-new.json --compare bench-1m.json
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+import generate_conditions
+import keylabs_to_yolo
+import utils
+
+# Number of boxes in the annotation CSV and in the file-based datasets
+# (Keylabs JSON, YOLO labels) for each scale
+SCALES = {
+    '10k': {'csv_boxes': 10_000, 'file_boxes': 10_000},
+    '1m': {'csv_boxes': 1_000_000, 'file_boxes': 200_000},
+    '10m': {'csv_boxes': 10_000_000, 'file_boxes': 1_000_000},
+}
+
+N_LABELS = 600
+N_RENDERED_IMAGES = 200
+KEYLABS_TYPES = ['water_vehicle', 'buoy', 'bird']
+
+
+def boxes_per_image(n_boxes, rng):
+    """
+    Draw skewed per-image box counts summing to n_boxes.
+
+    Most images get a handful of boxes, about 5% are crowded (15-60 boxes).
+    """
+    counts = []
+    total = 0
+    while total < n_boxes:
+        batch = rng.geometric(0.3, size=max(1024, (n_boxes - total) // 3))
+        crowded = rng.random(len(batch)) < 0.05
+        batch[crowded] = rng.integers(15, 61, size=crowded.sum())
+        counts.append(batch)
+        total += batch.sum()
+    counts = np.concatenate(counts)
+    cutoff = np.searchsorted(np.cumsum(counts), n_boxes)
+    counts = counts[:cutoff + 1]
+    counts[-1] -= counts.sum() - n_boxes
+    return counts[counts > 0]
+
+
+def random_boxes(n, rng):
+    """Return (xmin, xmax, ymin, ymax) arrays of normalized boxes."""
+    width = rng.uniform(0.01, 0.3, n)
+    height = rng.uniform(0.01, 0.3, n)
+    xmin = rng.uniform(0, 1 - width)
+    ymin = rng.uniform(0, 1 - height)
+    return xmin, xmin + width, ymin, ymin + height
+
+
+def make_open_images(data_dir, n_boxes, rng):
+    """Write an annotation CSV, class descriptions CSV and hierarchy JSON."""
+    counts = boxes_per_image(n_boxes, rng)
+    labels = [f'/m/{i:05x}' for i in range(N_LABELS)]
+    display_names = ['Vehicle'] + [f'Class {i}' for i in range(1, N_LABELS)]
+
+    # Vehicle (label 0) gets the first 40 labels as a two-level subtree
+    hierarchy = {'LabelName': '/m/root', 'Subcategory': [
+        {'LabelName': labels[0], 'Subcategory': [
+            {'LabelName': labels[i], 'Subcategory': [{'LabelName': labels[j]} for j in range(i + 10, i + 13)]}
+            for i in range(1, 10)
+        ]},
+        *({'LabelName': label} for label in labels[40:]),
+    ]}
+
+    xmin, xmax, ymin, ymax = random_boxes(n_boxes, rng)
+    annotations = pd.DataFrame({
+        'ImageID': np.repeat([f'{i:016x}' for i in range(len(counts))], counts),
+        'Source': 'xclick',
+        'LabelName': np.array(labels)[rng.zipf(1.5, n_boxes) % N_LABELS],
+        'Confidence': 1,
+        'XMin': xmin, 'XMax': xmax, 'YMin': ymin, 'YMax': ymax,
+        'IsOccluded': (rng.random(n_boxes) < 0.4).astype(int),
+        'IsTruncated': (rng.random(n_boxes) < 0.2).astype(int),
+        'IsGroupOf': (rng.random(n_boxes) < 0.05).astype(int),
+        'IsDepiction': (rng.random(n_boxes) < 0.05).astype(int),
+        'IsInside': (rng.random(n_boxes) < 0.01).astype(int),
+    })
+    annotations.to_csv(data_dir / 'annotations-bbox.csv', index=False, float_format='%.6f')
+    pd.DataFrame({'LabelName': labels, 'DisplayName': display_names}).to_csv(
+        data_dir / 'class-descriptions.csv', index=False
+    )
+    with open(data_dir / 'hierarchy.json', 'w') as f:
+        json.dump(hierarchy, f)
+
+
+def make_keylabs_dir(keylabs_dir, n_boxes, rng):
+    """Write one Keylabs JSON file per image."""
+    keylabs_dir.mkdir(parents=True, exist_ok=True)
+    for i, count in enumerate(boxes_per_image(n_boxes, rng)):
+        types = rng.choice(KEYLABS_TYPES, count)
+        xmin, xmax, ymin, ymax = random_boxes(count, rng)
+        metadata = {
+            'file': f'images/{i:08d}.jpg', 'width': 1920, 'height': 1080,
+            'objects': [{'nm': f'obj{j}', 'type': str(t)} for j, t in enumerate(types)],
+        }
+        objects = [
+            {'nm': f'obj{j}', 'x1': xmin[j] * 1920, 'y1': ymin[j] * 1080, 'x2': xmax[j] * 1920,
+             'y2': ymax[j] * 1080, 'attributes': {'subcategory': 'unknown'}}
+            for j in range(count)
+        ]
+        with open(keylabs_dir / f'{i:08d}.json', 'w') as f:
+            json.dump([metadata, {'objects': objects}], f)
+
+
+def make_yolo_dir(labels_dir, images_dir, n_boxes, rng):
+    """Write YOLO label files, plus small reference JPEGs for the first images."""
+    labels_dir.mkdir(parents=True, exist_ok=True)
+    images_dir.mkdir(parents=True, exist_ok=True)
+    for i, count in enumerate(boxes_per_image(n_boxes, rng)):
+        xmin, xmax, ymin, ymax = random_boxes(count, rng)
+        class_ids = rng.integers(0, 80, count)
+        lines = [
+            f'{c} {(x0 + x1) / 2:.6f} {(y0 + y1) / 2:.6f} {x1 - x0:.6f} {y1 - y0:.6f}'
+            for c, x0, x1, y0, y1 in zip(class_ids, xmin, xmax, ymin, ymax)
+        ]
+        with open(labels_dir / f'{i:012d}.txt', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        if i < N_RENDERED_IMAGES:
+            Image.new('RGB', (640, 480), color=(90, 90, 90)).save(images_dir / f'{i:012d}.jpg')
+
+
+def prepare_data(data_dir, scale, seed):
+    """Create the synthetic datasets in data_dir unless they already exist."""
+    marker = data_dir / f'.complete-{scale}-{seed}'
+    if marker.exists():
+        return
+    if data_dir.exists():
+        shutil.rmtree(data_dir)
+    data_dir.mkdir(parents=True)
+
+    rng = np.random.default_rng(seed)
+    sizes = SCALES[scale]
+    logging.info(f"Generating synthetic data for scale {scale} in {data_dir}")
+    make_open_images(data_dir, sizes['csv_boxes'], rng)
+    make_keylabs_dir(data_dir / 'keylabs', sizes['file_boxes'], rng)
+    make_yolo_dir(data_dir / 'yolo_labels', data_dir / 'images', sizes['file_boxes'], rng)
+    marker.touch()
+
+
+def build_benchmarks(data_dir, work_dir):
+    """
+    Return (name, setup, run) triples.
+
+    setup() runs untimed before every measurement and returns the arguments
+    passed to run().
+    """
+    csv_path = data_dir / 'annotations-bbox.csv'
+    classes_path = data_dir / 'class-descriptions.csv'
+    hierarchy_path = data_dir / 'hierarchy.json'
+    yolo_dir = data_dir / 'yolo_labels'
+    images_dir = data_dir / 'images'
+    out_dir = work_dir / 'out'
+
+    def fresh_out_dir():
+        if out_dir.exists():
+            shutil.rmtree(out_dir)
+        return out_dir
+
+    def warm_table():
+        utils.load_annotation_table(csv_path)
+        return ()
+
+    def cold_table():
+        utils.clear_annotation_tables()
+        for sidecar in data_dir.glob('.annotations-bbox.csv.*.parquet'):
+            sidecar.unlink()
+        return ()
+
+    def cold_memo():
+        utils.clear_annotation_tables()
+        utils.load_annotation_table(csv_path)
+        utils.clear_annotation_tables()
+        return ()
+
+    def warm_out_dir():
+        warm_table()
+        return (fresh_out_dir(),)
+
+    def warm_classes():
+        utils.load_annotation_table(classes_path)
+        return ()
+
+    def hierarchy():
+        utils.clear_label_hierarchies()
+        return warm_classes()
+
+    vehicle_labels = utils.get_vehicle_labels(hierarchy_path, classes_path)
+    label_to_class_id = utils.create_label_to_class_id_mapping(vehicle_labels)
+    filters = {
+        'allowed_labels': vehicle_labels,
+        'attributes': {'is_occluded': None, 'is_truncated': None},
+        'overlap': {'keep_overlapping': False},
+    }
+
+    def index():
+        warm_table()
+        return (utils.get_dataframes_by_image_id(csv_path),)
+
+    def vehicle_index():
+        return (utils.filter_labels_by_category(index()[0], vehicle_labels),)
+
+    def keylabs_raw():
+        return (keylabs_to_yolo.read_label_files(data_dir / 'keylabs'),)
+
+    def keylabs_parsed():
+        return (keylabs_to_yolo.parse_labels(keylabs_raw()[0]),)
+
+    def keylabs_filtered():
+        return (keylabs_to_yolo.filter_for_obj_types(keylabs_parsed()[0], KEYLABS_TYPES),)
+
+    def warm_labels_cache():
+        generate_conditions.read_labels_dir(yolo_dir)
+        return ()
+
+    def yolo_labels():
+        labels = generate_conditions.read_labels_dir(yolo_dir)
+        stems = sorted(labels)[:N_RENDERED_IMAGES]
+        return ({stem: labels[stem] for stem in stems},)
+
+    def render_labels(labels):
+        for label_lines in labels.values():
+            generate_conditions.generate_image_from_label(label_lines, (640, 480))
+
+    def render_conditions(labels):
+        output_dir = fresh_out_dir()
+        output_dir.mkdir(parents=True)
+        for stem, label_lines in labels.items():
+            generate_conditions.generate_cond_img(images_dir, stem, label_lines, output_dir)
+
+    return [
+        # utils.py
+        ('utils.load_annotation_table[csv]', cold_table, lambda: utils.load_annotation_table(csv_path)),
+        ('utils.load_annotation_table[sidecar]', cold_memo, lambda: utils.load_annotation_table(csv_path)),
+        ('utils.get_unique_values', warm_table, lambda: utils.get_unique_values(csv_path, 'LabelName')),
+        ('utils.get_dataframes_by_image_id', warm_table, lambda: utils.get_dataframes_by_image_id(csv_path)),
+        ('utils.get_entry_count_distribution', warm_table, lambda: utils.get_entry_count_distribution(csv_path)),
+        ('utils.load_class_descriptions', warm_classes, lambda: utils.load_class_descriptions(classes_path)),
+        ('utils.get_labels_by_subcategory', hierarchy,
+         lambda: utils.get_labels_by_subcategory(hierarchy_path, vehicle_labels[0])),
+        ('utils.get_vehicle_labels', hierarchy, lambda: utils.get_vehicle_labels(hierarchy_path, classes_path)),
+        ('utils.filter_labels_by_category', index, lambda i: utils.filter_labels_by_category(i, vehicle_labels)),
+        ('utils.filter_by_label_attributes', vehicle_index,
+         lambda i: utils.filter_by_label_attributes(i, is_occluded=None, is_truncated=None)),
+        ('utils.filter_by_bbox_overlap', vehicle_index, lambda i: utils.filter_by_bbox_overlap(i)),
+        ('utils.bbox_overlap_stats', vehicle_index, lambda i: utils.bbox_overlap_stats(i)),
+        ('utils.get_entry_count_distribution_from_dict', index,
+         lambda i: utils.get_entry_count_distribution_from_dict(i)),
+        ('utils.convert_to_yolo_format', vehicle_index,
+         lambda i: utils.convert_to_yolo_format(i, label_to_class_id)),
+        ('utils.write_yolo_labels', lambda: vehicle_index() + (fresh_out_dir(),),
+         lambda i, out: utils.write_yolo_labels(i, label_to_class_id, out)),
+        ('utils.filter_csv_to_yolo[memory]', warm_out_dir,
+         lambda out: utils.filter_csv_to_yolo(csv_path, out, label_to_class_id, **filters)),
+        ('utils.filter_csv_to_yolo[streaming]', lambda: (fresh_out_dir(),),
+         lambda out: utils.filter_csv_to_yolo(csv_path, out, label_to_class_id, chunksize=500_000, **filters)),
+        ('utils.filter_csv_to_yolo[parallel]', warm_out_dir,
+         lambda out: utils.filter_csv_to_yolo(csv_path, out, label_to_class_id, num_workers=4, **filters)),
+        # keylabs_to_yolo.py
+        ('keylabs_to_yolo.read_label_files', lambda: (),
+         lambda: keylabs_to_yolo.read_label_files(data_dir / 'keylabs')),
+        ('keylabs_to_yolo.parse_labels', keylabs_raw, keylabs_to_yolo.parse_labels),
+        ('keylabs_to_yolo.filter_for_obj_types', keylabs_parsed,
+         lambda labels: keylabs_to_yolo.filter_for_obj_types(labels, KEYLABS_TYPES)),
+        ('keylabs_to_yolo.compute_size_statistics', keylabs_filtered,
+         lambda labels: keylabs_to_yolo.compute_size_statistics(labels, 500.0)),
+        ('keylabs_to_yolo.save_yolo_labels', lambda: keylabs_filtered() + (fresh_out_dir(),),
+         keylabs_to_yolo.save_yolo_labels),
+        # generate_conditions.py
+        ('generate_conditions.read_labels_dir[parse]', lambda: (),
+         lambda: generate_conditions.read_labels_dir(yolo_dir, use_cache=False)),
+        ('generate_conditions.read_labels_dir[cache]', warm_labels_cache,
+         lambda: generate_conditions.read_labels_dir(yolo_dir)),
+        (f'generate_conditions.generate_image_from_label[x{N_RENDERED_IMAGES}]', yolo_labels, render_labels),
+        (f'generate_conditions.generate_cond_img[x{N_RENDERED_IMAGES}]', yolo_labels, render_conditions),
+    ]
+
+
+def max_rss_mb(who=resource.RUSAGE_SELF):
+    """Peak resident set size of this process (or of its largest waited-for child) in MB."""
+    if who == resource.RUSAGE_SELF:
+        # ru_maxrss of a spawned process starts at its parent's RSS at fork time,
+        # Linux's VmHWM starts from zero at exec
+        try:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) / 2**10
+        except OSError:
+            pass
+    max_rss = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return max_rss / 2**20 if sys.platform == 'darwin' else max_rss / 2**10
+
+
+def _rss_in_fresh_process(data_dir, work_dir, name):
+    setup, run = {n: (setup, run) for n, setup, run in build_benchmarks(data_dir, work_dir)}[name]
+    args = setup()
+    setup_rss_mb = max_rss_mb()
+    run(*args)
+    worker_rss_mb = max_rss_mb(resource.RUSAGE_CHILDREN)
+    return {
+        'peak_rss_mb': max(max_rss_mb(), worker_rss_mb),
+        'setup_rss_mb': setup_rss_mb,
+        'worker_peak_rss_mb': worker_rss_mb,
+    }
+
+
+def measure_rss(data_dir, work_dir, name):
+    """
+    Run setup and one run of a benchmark in a fresh interpreter and return its peak RSS.
+
+    Unlike tracemalloc this covers native allocations (pandas parser, Arrow
+    buffers) and the worker processes of the parallel benchmarks.
+    peak_rss_mb is the peak of the benchmark process or its largest worker,
+    worker_peak_rss_mb that of the largest worker alone (0 without workers)
+    and setup_rss_mb the benchmark process's peak before the timed call,
+    including the interpreter and imports.
+    """
+    # Pool workers are daemonic and could not start the parallel benchmarks' workers
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(_rss_in_fresh_process, data_dir, work_dir, name).result()
+
+
+def measure(setup, run, repeat):
+    """Return the best wall time over repeat runs and the peak traced memory of one run."""
+    times = []
+    for _ in range(repeat):
+        args = setup()
+        start = time.perf_counter()
+        run(*args)
+        times.append(time.perf_counter() - start)
+
+    args = setup()
+    tracemalloc.start()
+    try:
+        run(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'seconds': min(times), 'peak_mb': peak / 2**20, 'repeat': repeat}
+
+
+def compare(results, baseline_path, threshold):
+    """Print a comparison against an earlier results file and return the regressed names."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)['results']
+
+    regressions = []
+    print(f"\n{'benchmark':<60} {'time':>10} {'base':>10} {'ratio':>7} {'peak MB':>9} {'ratio':>7} {'RSS MB':>9} {'ratio':>7}")
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"{name:<60} {result['seconds']:>10.4f} {'-':>10}")
+            continue
+        base = baseline[name]
+        time_ratio = result['seconds'] / base['seconds'] if base['seconds'] else float('inf')
+        mem_ratio = result['peak_mb'] / base['peak_mb'] if base['peak_mb'] else float('inf')
+        # Result files written before peak RSS was recorded have no baseline for it
+        rss_ratio = result['peak_rss_mb'] / base['peak_rss_mb'] if base.get('peak_rss_mb') else float('nan')
+        flag = '  <-- regression' if max(time_ratio, mem_ratio, rss_ratio) > threshold else ''
+        if flag:
+            regressions.append(name)
+        print(f"{name:<60} {result['seconds']:>10.4f} {base['seconds']:>10.4f} {time_ratio:>7.2f} "
+              f"{result['peak_mb']:>9.1f} {mem_ratio:>7.2f} {result['peak_rss_mb']:>9.1f} {rss_ratio:>7.2f}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the annotation filtering and conversion helpers.')
+    parser.add_argument('--scale', choices=SCALES, default='10k', help='Size of the synthetic datasets')
+    parser.add_argument('--output', type=Path, default=Path('benchmark-results.json'), help='Results JSON file')
+    parser.add_argument('--compare', type=Path, help='Earlier results JSON file to compare against')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='Time or memory ratio above which a benchmark counts as regressed')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per benchmark (best is kept)')
+    parser.add_argument('--filter', default='', help='Only run benchmarks whose name contains this string')
+    parser.add_argument('--data-dir', type=Path,
+                        help='Directory for the synthetic data, reused across runs (default: temporary)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the synthetic data')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        data_dir = args.data_dir or Path(tmp) / 'data'
+        prepare_data(data_dir, args.scale, args.seed)
+
+        results = {}
+        for name, setup, run in build_benchmarks(data_dir, Path(tmp)):
+            if args.filter not in name:
+                continue
+            results[name] = measure(setup, run, args.repeat)
+            results[name].update(measure_rss(data_dir, Path(tmp), name))
+            logging.info(f"{name}: {results[name]['seconds']:.4f}s, peak {results[name]['peak_mb']:.1f} MB, "
+                         f"peak RSS {results[name]['peak_rss_mb']:.1f} MB")
+
+    report = {
+        'meta': {
+            'scale': args.scale,
+            **SCALES[args.scale],
+            'seed': args.seed,
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    logging.info(f"Results written to {args.output}")
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        if regressions:
+            raise SystemExit(f"{len(regressions)} benchmark(s) regressed beyond {args.threshold}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Once over max_bytes, evict down to this fraction of it, so eviction runs rarely
+EVICTION_LOW_WATERMARK = 0.9
+
+
+def default_cache_path() -> Path:
+    """Caption cache shared by all runs of a user, under ``$XDG_CACHE_HOME/werkzeug``."""
+    cache_home = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache")
+    return cache_home / "werkzeug" / "captions.sqlite"
+
+
+def hash_image_file(image_path: Path) -> str:
+    """sha256 of an image file's content, so renamed or copied images still hit the cache."""
+    digest = hashlib.sha256()
+    with open(image_path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_image_files(image_paths: list[Path], num_threads: int = 8) -> list[str]:
+    """hash_image_file for many images; hashing releases the GIL, so threads read and hash in parallel."""
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        return list(executor.map(hash_image_file, image_paths))
+
+
+class CaptionCache:
+    """Persistent caption cache in SQLite, shared across runs and processes.
+
+    Captions are keyed by the image content hash, the model id, a hash of
+    the prompt and the generation parameters, so any change to what would
+    be generated is a miss. The database uses WAL mode, so several
+    captioner replicas can read and write it at the same time.
+
+    With ``max_bytes``, the least recently used captions are evicted once
+    the stored captions exceed that size. The size is tracked as a running
+    total of this process's inserts and recounted only when the total
+    crosses the bound, so captions added by other processes are noticed
+    late and the bound is approximate while several processes write.
+
+    Args:
+        path: SQLite database file.
+        max_bytes: Size bound for the stored captions, unbounded if None.
+    """
+
+    def __init__(self, path: Path, max_bytes: int | None = None):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(self.path, timeout=60)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS captions (key TEXT PRIMARY KEY, caption TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS captions_last_used ON captions (last_used)")
+        self._size_estimate = self.size_bytes() if max_bytes is not None else 0
+
+    @staticmethod
+    def make_key(image_hash: str, model_id: str, prompt: str, generation_params: dict) -> str:
+        """Cache key for one image under one model, prompt and set of generation parameters."""
+        prompt_hash = hashlib.sha256(prompt.encode()).hexdigest()
+        key = json.dumps([image_hash, model_id, prompt_hash, generation_params], sort_keys=True)
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def get_many(self, keys: list[str]) -> dict[str, str]:
+        """Look up captions, counting hits and misses and marking hits as recently used."""
+        found = {}
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self._connection.execute(f"SELECT key, caption FROM captions WHERE key IN ({placeholders})", chunk)
+            found.update(rows)
+        if found:
+            with self._connection:
+                self._connection.executemany("UPDATE captions SET last_used = ? WHERE key = ?", [(time.time(), key) for key in found])
+        self.hits += len(found)
+        self.misses += len(set(keys)) - len(found)
+        return found
+
+    def get(self, key: str) -> str | None:
+        return self.get_many([key]).get(key)
+
+    def put_many(self, captions: dict[str, str]) -> None:
+        """Store captions, then evict least recently used ones if the cache is over its size bound."""
+        now = time.time()
+        rows = [(key, caption, len(key) + len(caption.encode()), now) for key, caption in captions.items()]
+        with self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO captions (key, caption, size, last_used) VALUES (?, ?, ?, ?)", rows)
+        # Replaced captions are counted twice; that only makes the recount in evict happen earlier
+        self._size_estimate += sum(row[2] for row in rows)
+        if self.max_bytes is not None and self._size_estimate > self.max_bytes:
+            self.evict(int(self.max_bytes * EVICTION_LOW_WATERMARK))
+
+    def evict(self, max_bytes: int) -> int:
+        """Delete least recently used captions until the stored size is at most max_bytes.
+
+        Returns:
+            The number of evicted captions.
+        """
+        total = self.size_bytes()
+        if total <= max_bytes:
+            self._size_estimate = total
+            return 0
+        evicted = 0
+        with self._connection:
+            rows = self._connection.execute("SELECT key, size FROM captions ORDER BY last_used")
+            keys = []
+            for key, size in rows:
+                if total <= max_bytes:
+                    break
+                keys.append((key,))
+                total -= size
+            self._connection.executemany("DELETE FROM captions WHERE key = ?", keys)
+            evicted = len(keys)
+        self._size_estimate = total
+        logger.info(f"Evicted {evicted} captions from {self.path}")
+        return evicted
+
+    def size_bytes(self) -> int:
+        return self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM captions").fetchone()[0]
+
+    def __len__(self) -> int:
+        return self._connection.execute("SELECT COUNT(*) FROM captions").fetchone()[0]
+
+    def stats(self) -> str:
+        lookups = self.hits + self.misses
+        hit_rate = 100 * self.hits / lookups if lookups else 0.0
+        return f"{self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate), {len(self)} captions, {self.size_bytes() / 2**20:.1f} MiB"
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def __enter__(self) -> "CaptionCache":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
@@ -3,9 +3,10 @@ from pathlib import Path
 import torch
 import shutil
 from PIL import Image
-import json
 from tqdm import tqdm
 
+from metadata_io import JsonlWriter
+
 
 def remove_path(path: Path):
     """Remove file or directory if it exists."""
@@ -29,28 +30,26 @@ def convert_to_metadatajsonl(
     conditions_path.mkdir(parents=True, exist_ok=True)
 
     metadata_path = output_path / "metadata.jsonl"
-    metadata: list[dict[str, str]] = []
-    for i in tqdm(range(len(train_ds))):
-        x = train_ds[i]
-        img_id = f"img_{i:07d}.png"
-        caption: str = x["caption"]
-        image: Image.Image = x["image"]
-        conditioning_image: Image.Image = x["conditioning_image"]
-        condition_path = conditions_path / img_id
-        img_path = output_path / img_id
-
-        if save_images:
-            image.save(img_path)
-            conditioning_image.save(condition_path)
+    with JsonlWriter(metadata_path) as writer:
+        for i in tqdm(range(len(train_ds))):
+            x = train_ds[i]
+            img_id = f"img_{i:07d}.png"
+            caption: str = x["caption"]
+            image: Image.Image = x["image"]
+            conditioning_image: Image.Image = x["conditioning_image"]
+            condition_path = conditions_path / img_id
+            img_path = output_path / img_id
 
-        json_obj: dict[str, str] = {
-            "image": str(img_path.relative_to(output_path)),
-            "conditioning_image": str(condition_path.relative_to(output_path)),
-            "caption": caption,
-        }
-        metadata.append(json_obj)
+            if save_images:
+                image.save(img_path)
+                conditioning_image.save(condition_path)
 
-    json.dump(metadata, metadata_path.open("w"), indent=4)
+            json_obj: dict[str, str] = {
+                "image": str(img_path.relative_to(output_path)),
+                "conditioning_image": str(condition_path.relative_to(output_path)),
+                "caption": caption,
+            }
+            writer.write(json_obj)
 
 
 data_dir = "/home/azureuser/data/openpose/raulc0399___open_pose_controlnet"
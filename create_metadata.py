@@ -1,43 +1,70 @@
-import json
+import argparse
 import logging
+import os
+import queue
+import time
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
 
 import torch
 from tqdm import tqdm
-from transformers import Qwen2_5_VLForConditionalGeneration, AutoProcessor
+from transformers import BatchFeature, Qwen2_5_VLForConditionalGeneration, AutoProcessor
 from qwen_vl_utils import process_vision_info
+from qwen_vl_utils.vision_process import IMAGE_FACTOR, MAX_PIXELS, MIN_PIXELS, smart_resize
+
+from caption_cache import CaptionCache, default_cache_path, hash_image_files
+from image_probe import ImageSizeIndex
+from metadata_io import JsonlWriter, iter_jsonl, partial_path, repair_torn_tail, shard_output_path, sort_jsonl
 
 logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
 logger = logging.getLogger(__name__)
 
 # Configuration
+MODEL_ID = "Qwen/Qwen2.5-VL-7B-Instruct"
 IMAGE_DIR = Path("/home/azureuser/Tools/openimg_condition_dataset_creator/ir")
 OUTPUT_FILE = Path("/home/azureuser/Tools/openimg_condition_dataset_creator/ir-metadata-fixed-ship-count.jsonl")
-BATCH_SIZE = 8  # 80GB VRAM - can go higher if needed
+TOKEN_BUDGET = 32768  # padded tokens per batch (batch size x longest sequence), 80GB VRAM - can go higher if needed
+MAX_BATCH_SIZE = 64
+GENERATION_PARAMS = {"max_new_tokens": 64, "do_sample": False}  # greedy decoding for speed; part of the caption cache key
 
 # Supported image extensions
 IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp", ".tiff"}
 
 
-def load_model():
-    """Load the Qwen2.5-VL-7B-Instruct model and processor with optimizations."""
-    print("Loading Qwen2.5-VL-7B-Instruct model...")
+def load_model(model_id: str = MODEL_ID, device: str = "auto"):
+    """Load the Qwen2.5-VL model and processor with optimizations.
+
+    Args:
+        model_id: Hugging Face model id or local checkpoint, e.g. a tiny
+            stand-in model for testing.
+        device: "auto" spreads the model over the visible GPUs; otherwise
+            the whole model is placed on this device (e.g. "cuda:0", "cpu").
+    """
+    print(f"Loading {model_id} model...")
+    if device == "auto":
+        placement = {"device_map": "auto", "max_memory": {0: "80GiB"}}
+    else:
+        placement = {"device_map": {"": device}}
     model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
-        "Qwen/Qwen2.5-VL-7B-Instruct",
-        torch_dtype=torch.bfloat16,
-        device_map="auto",
-        max_memory={0: "80GiB"},
+        model_id,
+        torch_dtype=torch.float32 if device == "cpu" else torch.bfloat16,
+        **placement,
     )
-    processor = AutoProcessor.from_pretrained("Qwen/Qwen2.5-VL-7B-Instruct")
+    processor = AutoProcessor.from_pretrained(model_id)
     processor.tokenizer.padding_side = "left"
     print("Model loaded successfully.")
     return model, processor
 
 
 def get_image_files(image_dir: Path) -> list[Path]:
-    """Get all image files from the directory."""
+    """Get all image files from the directory, skipping hidden files such as the size index."""
     image_files = []
     for file in image_dir.iterdir():
+        if file.name.startswith("."):
+            continue
         if file.is_file():
             if file.suffix.lower() in IMAGE_EXTENSIONS:
                 image_files.append(file)
@@ -46,69 +73,342 @@ def get_image_files(image_dir: Path) -> list[Path]:
     return sorted(image_files)
 
 
-def generate_captions_batch(model, processor, image_paths: list[Path]) -> list[str]:
-    """Generate captions for a batch of images."""
-    # Build messages for each image
-    messages_batch = []
-    for image_path in image_paths:
-        messages = [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "image",
-                        "image": f"file://{image_path}",
-                    },
-                    {
-                        "type": "text",
-                        "text": "Describe this image in one short sentence. Use the word 'infrared' for describing the style of the image. Do not include ship counts or numbers, just use the word 'boat' or 'boats'.",
-                    },
-                ],
-            }
-        ]
-        messages_batch.append(messages)
-
-    # Process each message through the template
-    texts = []
+DEFAULT_PROMPT_FILE = Path(__file__).with_name("caption_prompt.txt")
+
+
+def build_messages(image_path: Path, prompt: str, instruction_first: bool = False) -> list[dict]:
+    """Chat messages asking for the caption of one image."""
+    content = [
+        {
+            "type": "image",
+            "image": f"file://{image_path}",
+        },
+        {
+            "type": "text",
+            "text": prompt,
+        },
+    ]
+    if instruction_first:
+        content.reverse()
+    return [
+        {
+            "role": "user",
+            "content": content,
+        }
+    ]
+
+
+class PromptTemplate:
+    """Token ids of the chat-templated prompt, computed once per run.
+
+    The template is rendered and tokenized once with a single image
+    placeholder; every request is then the prefix ids, one placeholder per
+    vision token and the suffix ids, which is exactly what the processor
+    produces from the templated text, without re-templating and
+    re-tokenizing the instruction for every image.
+
+    Args:
+        processor: Qwen2.5-VL processor.
+        prompt: Captioning instruction.
+        instruction_first: Put the instruction before the image, so it is part
+            of the prefix shared by all requests.
+    """
+
+    def __init__(self, processor, prompt: str, instruction_first: bool = False):
+        self.prompt = prompt
+        self.instruction_first = instruction_first
+        tokenizer = processor.tokenizer
+        text = processor.apply_chat_template(build_messages(Path("image"), prompt, instruction_first), tokenize=False, add_generation_prompt=True)
+        ids = tokenizer(text).input_ids
+        self.image_token_id = tokenizer.convert_tokens_to_ids(getattr(processor, "image_token", "<|image_pad|>"))
+        placeholder = ids.index(self.image_token_id)
+        self.prefix_ids = ids[:placeholder]
+        self.suffix_ids = ids[placeholder + 1:]
+        self.pad_token_id = tokenizer.pad_token_id
+        self.merge_length = processor.image_processor.merge_size ** 2
+
+    def __len__(self) -> int:
+        """Text tokens per request, excluding the vision tokens."""
+        return len(self.prefix_ids) + len(self.suffix_ids)
+
+    def encode(self, image_grid_thw: torch.Tensor) -> dict[str, torch.Tensor]:
+        """Left-padded input_ids and attention_mask for one image per request."""
+        vision_tokens = (image_grid_thw.prod(dim=-1) // self.merge_length).tolist()
+        lengths = [len(self) + count for count in vision_tokens]
+        input_ids = torch.full((len(lengths), max(lengths)), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(lengths), max(lengths)), dtype=torch.long)
+        for row, (count, length) in enumerate(zip(vision_tokens, lengths)):
+            input_ids[row, -length:] = torch.tensor(self.prefix_ids + [self.image_token_id] * count + self.suffix_ids)
+            attention_mask[row, -length:] = 1
+        return {"input_ids": input_ids, "attention_mask": attention_mask}
+
+
+def load_prompt(prompt: str | None, prompt_file: Path | None) -> str:
+    """The captioning instruction from --prompt, --prompt-file or the default prompt file."""
+    if prompt is not None:
+        return prompt
+    return (prompt_file or DEFAULT_PROMPT_FILE).read_text().strip()
+
+
+class PinnedBufferPool:
+    """Reusable pinned host buffers that batch inputs are staged in before the H2D copy.
+
+    Pinning a fresh tensor per batch allocates page-locked memory every
+    time; instead each slot keeps one growing pinned buffer per input name.
+    After a slot's tensors are copied to the GPU, a CUDA event is recorded
+    and the slot is only reused once that copy has finished.
+
+    Args:
+        num_slots: Batches that can be staged at once; must exceed the
+            number of batches prepared ahead of the GPU.
+    """
+
+    def __init__(self, num_slots: int):
+        self._free = queue.Queue()
+        for _ in range(num_slots):
+            self._free.put(_PinnedSlot())
+
+    def acquire(self) -> "_PinnedSlot":
+        slot = self._free.get()
+        if slot.copied is not None:
+            slot.copied.synchronize()
+            slot.copied = None
+        return slot
+
+    def release(self, slot: "_PinnedSlot", copied: "torch.cuda.Event | None" = None) -> None:
+        slot.copied = copied
+        self._free.put(slot)
+
+
+class _PinnedSlot:
+    def __init__(self):
+        self.buffers: dict[str, torch.Tensor] = {}
+        self.copied = None
+
+    def stage(self, name: str, tensor: torch.Tensor) -> torch.Tensor:
+        """Copy a tensor into this slot's pinned buffer for ``name`` and return the pinned view."""
+        tensor = tensor.contiguous()
+        nbytes = tensor.numel() * tensor.element_size()
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.numel() < nbytes:
+            buffer = torch.empty(max(nbytes, 2 * buffer.numel() if buffer is not None else 0), dtype=torch.uint8, pin_memory=True)
+            self.buffers[name] = buffer
+        pinned = buffer[:nbytes].view(tensor.dtype).view(tensor.shape)
+        pinned.copy_(tensor)
+        return pinned
+
+
+@dataclass
+class PreparedBatch:
+    inputs: object
+    slot: _PinnedSlot | None = None
+    preprocess_seconds: float = 0.0
+
+
+class BatchProfiler:
+    """Collects the per-batch time split into preprocess, H2D, generate and decode."""
+
+    STAGES = ("preprocess", "h2d", "generate", "decode")
+
+    def __init__(self):
+        self.totals = dict.fromkeys(self.STAGES, 0.0)
+        self.batches = 0
+        self.images = 0
+
+    def record(self, batch_size: int, **seconds: float) -> None:
+        self.batches += 1
+        self.images += batch_size
+        for stage, value in seconds.items():
+            self.totals[stage] += value
+        split = ", ".join(f"{stage} {1000 * seconds[stage]:.1f} ms" for stage in self.STAGES)
+        logger.info(f"Batch {self.batches} ({batch_size} images): {split}")
+
+    def summary(self) -> str:
+        total = sum(self.totals.values()) or 1.0
+        split = ", ".join(f"{stage} {self.totals[stage]:.1f} s ({100 * self.totals[stage] / total:.0f}%)" for stage in self.STAGES)
+        return f"{self.batches} batches, {self.images} images: {split}"
+
+
+def prepare_batch(processor, image_paths: list[Path], template: PromptTemplate, pool: PinnedBufferPool | None = None) -> PreparedBatch:
+    """CPU half of captioning: decode and resize images and build the inputs from the precomputed template.
+
+    Runs on preprocessing threads while the GPU generates the previous
+    batch. With a pool, tensors are staged in reusable pinned buffers so the
+    host-to-device copy can be asynchronous.
+    """
+    start = time.perf_counter()
     all_image_inputs = []
-    for messages in messages_batch:
-        text = processor.apply_chat_template(
-            messages, tokenize=False, add_generation_prompt=True
-        )
-        texts.append(text)
-        image_inputs, _ = process_vision_info(messages)
+    for image_path in image_paths:
+        image_inputs, _ = process_vision_info(build_messages(image_path, template.prompt))
         all_image_inputs.extend(image_inputs)
 
-    # Batch process
-    inputs = processor(
-        text=texts,
-        images=all_image_inputs,
-        padding=True,
-        return_tensors="pt",
-    )
-    inputs = inputs.to(model.device)
+    image_features = processor.image_processor(images=all_image_inputs, return_tensors="pt")
+    inputs = BatchFeature(data={**template.encode(image_features["image_grid_thw"]), **image_features})
+    slot = None
+    if pool is not None:
+        slot = pool.acquire()
+        try:
+            for key, value in inputs.items():
+                if isinstance(value, torch.Tensor):
+                    inputs[key] = slot.stage(key, value)
+        except BaseException:
+            pool.release(slot)
+            raise
+    return PreparedBatch(inputs, slot, time.perf_counter() - start)
 
-    # Clear image inputs from CPU memory
-    del all_image_inputs
 
-    # Generate captions (greedy decoding for speed)
-    with torch.inference_mode():
-        generated_ids = model.generate(**inputs, max_new_tokens=64, do_sample=False)
+def run_batch(model, processor, prepared: PreparedBatch, pool: PinnedBufferPool | None = None, profiler: BatchProfiler | None = None) -> list[str]:
+    """GPU half of captioning: copy prepared inputs to the device, generate and decode captions.
+
+    Nothing is freed or synchronized explicitly, so the caching allocator
+    stays warm between batches of similar shape.
+    """
+    # CUDA events time the GPU work without extra synchronization; perf_counter is used on CPU
+    timed_on_gpu = profiler is not None and torch.cuda.is_available()
+    if timed_on_gpu:
+        h2d_start, h2d_end, generate_end = (torch.cuda.Event(enable_timing=True) for _ in range(3))
+        h2d_start.record()
+    h2d_start_time = time.perf_counter()
+    try:
+        inputs = prepared.inputs.to(model.device, non_blocking=True)
+    finally:
+        if prepared.slot is not None:
+            copied = torch.cuda.Event()
+            copied.record()
+            pool.release(prepared.slot, copied)
+    if timed_on_gpu:
+        h2d_end.record()
+    generate_start_time = time.perf_counter()
 
-    # Decode outputs
-    captions = []
-    for in_ids, out_ids in zip(inputs.input_ids, generated_ids):
-        trimmed = out_ids[len(in_ids):]
-        caption = processor.decode(trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False)
-        captions.append(caption.strip())
+    # Generate captions
+    with torch.inference_mode():
+        generated_ids = model.generate(**inputs, **GENERATION_PARAMS)
+    if timed_on_gpu:
+        generate_end.record()
 
-    # Cleanup GPU memory
-    del inputs, generated_ids
-    torch.cuda.empty_cache()
+    # Inputs are left-padded to the same length; copy only the new tokens to the host, once
+    decode_start = time.perf_counter()
+    new_ids = generated_ids[:, inputs.input_ids.shape[1]:].cpu()
+    captions = processor.batch_decode(new_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+    captions = [caption.strip() for caption in captions]
 
+    if profiler is not None:
+        decode_seconds = time.perf_counter() - decode_start
+        if timed_on_gpu:
+            h2d_seconds = h2d_start.elapsed_time(h2d_end) / 1000
+            generate_seconds = h2d_end.elapsed_time(generate_end) / 1000
+        else:
+            h2d_seconds, generate_seconds = generate_start_time - h2d_start_time, decode_start - generate_start_time
+        profiler.record(len(captions), preprocess=prepared.preprocess_seconds, h2d=h2d_seconds, generate=generate_seconds, decode=decode_seconds)
     return captions
 
 
+def generate_captions_batch(model, processor, image_paths: list[Path], template: PromptTemplate) -> list[str]:
+    """Generate captions for a batch of images."""
+    return run_batch(model, processor, prepare_batch(processor, image_paths, template))
+
+
+def iter_prepared_batches(processor, batches, template: PromptTemplate, num_workers: int = 4, prefetch: int = 8, pool: PinnedBufferPool | None = None):
+    """Prepare batches on a thread pool, at most ``prefetch`` ahead of the consumer.
+
+    Image decoding and tokenization release the GIL, so threads overlap them
+    with generation on the main thread without copying tensors between
+    processes. ``batches`` is consumed lazily (e.g. a TokenBudgetBatcher).
+    A pinned buffer pool needs more than ``prefetch`` + 1 slots.
+
+    Yields:
+        (batch_paths, future) in order; the future holds the PreparedBatch
+        or the preprocessing error.
+    """
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        pending = deque()
+        batches = iter(batches)
+        for batch_paths in batches:
+            pending.append((batch_paths, executor.submit(prepare_batch, processor, batch_paths, template, pool)))
+            if len(pending) >= prefetch:
+                break
+        while pending:
+            yield pending.popleft()
+            for batch_paths in batches:
+                pending.append((batch_paths, executor.submit(prepare_batch, processor, batch_paths, template, pool)))
+                break
+
+
+def predict_vision_tokens(image_size: tuple[int, int], min_pixels: int = MIN_PIXELS, max_pixels: int = MAX_PIXELS) -> int:
+    """Number of vision tokens Qwen2.5-VL produces for an image of this (width, height)."""
+    width, height = image_size
+    resized_height, resized_width = smart_resize(height, width, factor=IMAGE_FACTOR, min_pixels=min_pixels, max_pixels=max_pixels)
+    return (resized_height // IMAGE_FACTOR) * (resized_width // IMAGE_FACTOR)
+
+
+class TokenBudgetBatcher:
+    """Packs images into batches by padded sequence length instead of a fixed count.
+
+    Images are sorted by predicted sequence length, so each batch holds
+    similar lengths and little padding; a batch grows while batch size times
+    its longest sequence stays within ``token_budget``. Batches are formed
+    lazily, so a budget lowered after an out-of-memory error applies to all
+    batches that have not been formed yet.
+
+    Args:
+        image_paths: Images to caption.
+        sequence_lengths: Predicted prompt plus vision tokens per image.
+        token_budget: Maximum padded tokens per batch; a single longer image still forms its own batch.
+        max_batch_size: Maximum number of images per batch.
+    """
+
+    def __init__(self, image_paths: list[Path], sequence_lengths: list[int], token_budget: int = TOKEN_BUDGET, max_batch_size: int = MAX_BATCH_SIZE):
+        self.token_budget = token_budget
+        self.max_batch_size = max_batch_size
+        self.sequence_lengths = dict(zip(image_paths, sequence_lengths))
+        self._queue = deque(sorted(image_paths, key=self.sequence_lengths.__getitem__))
+
+    def __len__(self) -> int:
+        """Number of images not yet handed out in a batch."""
+        return len(self._queue)
+
+    def padded_tokens(self, batch_paths: list[Path]) -> int:
+        return len(batch_paths) * max(self.sequence_lengths[path] for path in batch_paths)
+
+    def _take(self, queue: deque) -> list[Path]:
+        batch = [queue.popleft()]
+        while queue and len(batch) < self.max_batch_size:
+            # The queue is sorted, so the next image is the longest of the batch
+            if (len(batch) + 1) * self.sequence_lengths[queue[0]] > self.token_budget:
+                break
+            batch.append(queue.popleft())
+        return batch
+
+    def __iter__(self):
+        while self._queue:
+            yield self._take(self._queue)
+
+    def shrink(self, failed_batch: list[Path]) -> bool:
+        """Halve the budget below the padded size of a batch that ran out of memory.
+
+        Batches formed (e.g. prefetched) before an earlier shrink can exceed the
+        current budget; their failure says nothing new about it, so the budget
+        is kept and split() re-packs them under it.
+
+        Returns:
+            Whether the budget was lowered.
+        """
+        padded_tokens = self.padded_tokens(failed_batch)
+        if padded_tokens > self.token_budget:
+            return False
+        self.token_budget = max(padded_tokens // 2, 1)
+        logger.warning(f"Out of memory on {len(failed_batch)} images, lowering the token budget to {self.token_budget}")
+        return True
+
+    def split(self, batch_paths: list[Path]) -> list[list[Path]]:
+        """Re-pack the images of one batch with the current budget."""
+        queue = deque(sorted(batch_paths, key=self.sequence_lengths.__getitem__))
+        batches = []
+        while queue:
+            batches.append(self._take(queue))
+        return batches
+
+
 def create_metadata_entry(image_path: Path, caption: str) -> dict:
     """Create a metadata entry for an image."""
     filename = image_path.name
@@ -121,42 +421,260 @@ def create_metadata_entry(image_path: Path, caption: str) -> dict:
     }
 
 
+def _time_forward(model, repeats: int = 3, **inputs) -> float:
+    """Best-of-``repeats`` seconds for one forward pass, i.e. the prefill of a request batch."""
+    best = float("inf")
+    for _ in range(repeats):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        with torch.inference_mode():
+            model(**inputs, use_cache=True)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchmark_prefill(model, processor, template: PromptTemplate, image_paths: list[Path], batch_sizes: list[int], repeats: int = 3) -> None:
+    """Log prefill time of full requests against the prefix all requests share.
+
+    The shared prefix time is the most that reusing its KV state could save
+    per batch; with --instruction-first the instruction is part of it.
+    """
+    for batch_size in batch_sizes:
+        batch_paths = image_paths[:batch_size]
+        inputs = prepare_batch(processor, batch_paths, template).inputs.to(model.device)
+        prefix_ids = torch.tensor([template.prefix_ids] * len(batch_paths), device=model.device)
+        _time_forward(model, 1, **inputs)  # warm-up
+        full_seconds = _time_forward(model, repeats, **inputs)
+        prefix_seconds = _time_forward(model, repeats, input_ids=prefix_ids)
+        logger.info(
+            f"Batch {len(batch_paths)}: prefill {1000 * full_seconds:.1f} ms for {inputs['input_ids'].shape[1]} tokens/request, "
+            f"shared prefix {len(template.prefix_ids)} tokens/request {1000 * prefix_seconds:.1f} ms "
+            f"({100 * prefix_seconds / full_seconds:.1f}% of prefill)"
+        )
+
+
+def parse_shard(value: str) -> tuple[int, int]:
+    """Parse a ``--shard i/n`` argument into (index, count)."""
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected a shard like 0/4, got {value!r}")
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"Shard index must be in [0, {count}), got {index}")
+    return index, count
+
+
+def select_shard(image_files: list[Path], index: int, count: int) -> list[Path]:
+    """Images of one shard, assigned by a stable hash of the file name so shards never overlap."""
+    return [path for path in image_files if zlib.crc32(path.name.encode()) % count == index]
+
+
+def completed_file_names(output_file: Path) -> set[str]:
+    """file_names already captioned in an existing output (or the partial file of an interrupted run).
+
+    An interrupted run without --resume leaves its captions in the partial
+    file; it is adopted as the output so they are not lost.
+    """
+    if not output_file.exists() and partial_path(output_file).exists():
+        os.replace(partial_path(output_file), output_file)
+    if not output_file.exists():
+        return set()
+    repair_torn_tail(output_file)
+    return {entry["file_name"] for entry in iter_jsonl(output_file)}
+
+
+def lookup_cached_captions(
+    cache: CaptionCache, image_files: list[Path], model_id: str, prompt: str, instruction_first: bool, num_threads: int = 8
+) -> tuple[list[dict], list[Path], dict[str, str]]:
+    """Split images into those with a cached caption and those still to caption.
+
+    Args:
+        cache: Caption cache to look the images up in.
+        image_files: Images to caption.
+        model_id, prompt, instruction_first: Captioning settings; together
+            with GENERATION_PARAMS they are part of the cache key.
+        num_threads: Threads hashing the image files.
+
+    Returns:
+        Metadata entries of the cached images, the uncached images and the
+        cache key of every image by file name.
+    """
+    generation_params = {**GENERATION_PARAMS, "instruction_first": instruction_first}
+    image_hashes = hash_image_files(image_files, num_threads)
+    cache_keys = {
+        path.name: CaptionCache.make_key(image_hash, model_id, prompt, generation_params) for path, image_hash in zip(image_files, image_hashes)
+    }
+    cached = cache.get_many(list(cache_keys.values()))
+    cached_entries = [create_metadata_entry(path, cached[cache_keys[path.name]]) for path in image_files if cache_keys[path.name] in cached]
+    uncached_files = [path for path in image_files if cache_keys[path.name] not in cached]
+    return cached_entries, uncached_files, cache_keys
+
+
+def caption_batch(
+    model,
+    processor,
+    batch_paths: list[Path],
+    template: PromptTemplate,
+    prepared: Future | None = None,
+    batcher: TokenBudgetBatcher | None = None,
+    pool: PinnedBufferPool | None = None,
+    profiler: BatchProfiler | None = None,
+) -> list[dict]:
+    """Caption a batch; failed images are skipped.
+
+    On out-of-memory errors the batcher's budget is lowered and the batch is
+    re-split under it. Other errors fall back to captioning the images one
+    by one.
+
+    Args:
+        prepared: Future with the batch's PreparedBatch, e.g. from
+            iter_prepared_batches; prepared inline if None.
+        batcher: Batcher whose budget adapts to out-of-memory errors.
+        pool: Pinned buffer pool the batch was (or is) staged in.
+        profiler: Collects the per-batch time split.
+    """
+    out_of_memory = None
+    try:
+        prepared = prepared.result() if prepared is not None else prepare_batch(processor, batch_paths, template, pool)
+        captions = run_batch(model, processor, prepared, pool, profiler)
+        return [create_metadata_entry(image_path, caption) for image_path, caption in zip(batch_paths, captions)]
+    except torch.cuda.OutOfMemoryError as e:
+        # Handled after the except block: until it exits, the traceback keeps the failed batch's device tensors alive
+        out_of_memory = str(e)
+    except Exception as e:
+        logger.error(f"Error processing batch starting at {batch_paths[0].name}: {e}")
+
+    if out_of_memory is not None:
+        # Only here is cached memory released, so the smaller batches can use it
+        prepared = None
+        torch.cuda.empty_cache()
+        if batcher is None or len(batch_paths) == 1:
+            logger.error(f"Out of memory processing batch starting at {batch_paths[0].name}: {out_of_memory}")
+            return []
+        batcher.shrink(batch_paths)
+        entries = []
+        for sub_batch in batcher.split(batch_paths):
+            entries.extend(caption_batch(model, processor, sub_batch, template, batcher=batcher, pool=pool, profiler=profiler))
+        return entries
+
+    entries = []
+    for image_path in batch_paths:
+        try:
+            captions = generate_captions_batch(model, processor, [image_path], template)
+            entries.append(create_metadata_entry(image_path, captions[0]))
+        except Exception as e2:
+            logger.error(f"Error processing {image_path.name}: {e2}")
+    return entries
+
+
 def main():
-    # Load model
-    model, processor = load_model()
+    parser = argparse.ArgumentParser(description="Caption images with Qwen2.5-VL and write metadata JSONL.")
+    parser.add_argument("--image-dir", type=Path, default=IMAGE_DIR)
+    parser.add_argument("--model-id", default=MODEL_ID)
+    parser.add_argument("--device", default="auto", help='"auto" (all visible GPUs), or one device such as "cuda:0" or "cpu"')
+    parser.add_argument("--output", type=Path, default=OUTPUT_FILE)
+    parser.add_argument("--token-budget", type=int, default=TOKEN_BUDGET, help="Maximum padded tokens per batch; lowered automatically on OOM")
+    parser.add_argument("--max-batch-size", type=int, default=MAX_BATCH_SIZE)
+    parser.add_argument(
+        "--size-index",
+        type=Path,
+        default=None,
+        help="Image size index file (default: IMAGE_DIR/.caption_image_sizes.json); with --shard, each shard gets its own",
+    )
+    parser.add_argument("--preprocess-workers", type=int, default=4, help="Threads preparing batches while the GPU generates")
+    parser.add_argument("--prefetch-batches", type=int, default=8, help="Maximum number of prepared batches waiting for the GPU")
+    parser.add_argument("--profile", action="store_true", help="Log per-batch preprocess/H2D/generate/decode times")
+    parser.add_argument("--resume", action="store_true", help="Skip images already in the output and append to it")
+    parser.add_argument(
+        "--shard", type=parse_shard, default=None, metavar="I/N", help="Only caption shard I of N; writes OUTPUT.shard-I-of-N.jsonl"
+    )
+    prompt_group = parser.add_mutually_exclusive_group()
+    prompt_group.add_argument("--prompt", default=None, help="Captioning instruction")
+    prompt_group.add_argument("--prompt-file", type=Path, default=None, help=f"File with the captioning instruction (default: {DEFAULT_PROMPT_FILE.name})")
+    parser.add_argument("--instruction-first", action="store_true", help="Put the instruction before the image in the chat template")
+    parser.add_argument("--cache", type=Path, default=default_cache_path(), help="Caption cache shared across runs (default: %(default)s)")
+    parser.add_argument("--no-cache", action="store_true", help="Caption every image without reading or filling the cache")
+    parser.add_argument("--cache-max-mb", type=float, default=None, help="Evict least recently used captions beyond this size")
+    parser.add_argument("--benchmark-prefill", action="store_true", help="Measure prefill time of full requests vs. the shared prefix and exit")
+    parser.add_argument("--benchmark-batch-sizes", type=int, nargs="+", default=[1, 8, 32])
+    args = parser.parse_args()
+    prompt = load_prompt(args.prompt, args.prompt_file)
+
+    output_file = args.output
+    image_files = get_image_files(args.image_dir)
+    print(f"Found {len(image_files)} images in {args.image_dir}")
+    if args.shard is not None:
+        image_files = select_shard(image_files, *args.shard)
+        output_file = shard_output_path(args.output, *args.shard)
+        print(f"Shard {args.shard[0]}/{args.shard[1]}: {len(image_files)} images")
 
-    # Get all image files
-    image_files = get_image_files(IMAGE_DIR)
-    print(f"Found {len(image_files)} images in {IMAGE_DIR}")
+    if args.resume:
+        done = completed_file_names(output_file)
+        image_files = [path for path in image_files if path.name not in done]
+        print(f"Resuming: {len(done)} images already captioned, {len(image_files)} remaining")
 
     if not image_files:
-        print("No images found. Exiting.")
+        print("No images to caption. Exiting.")
+        return
+
+    # Images captioned before with the same model, prompt and generation parameters only cost hashing
+    cache, cached_entries = None, []
+    if not args.no_cache and not args.benchmark_prefill:
+        max_bytes = int(args.cache_max_mb * 2**20) if args.cache_max_mb is not None else None
+        cache = CaptionCache(args.cache, max_bytes)
+        cached_entries, image_files, cache_keys = lookup_cached_captions(
+            cache, image_files, args.model_id, prompt, args.instruction_first, args.preprocess_workers
+        )
+        print(f"Caption cache: {len(cached_entries)} cached, {len(image_files)} images to caption")
+        if not image_files:
+            with JsonlWriter(output_file, append=args.resume) as writer:
+                writer.write_batch(cached_entries)
+            sort_jsonl([output_file], output_file)
+            logger.info(f"Caption cache: {cache.stats()}")
+            cache.close()
+            print(f"\nMetadata saved to {output_file}")
+            return
+
+    # Load model
+    model, processor = load_model(args.model_id, args.device)
+    template = PromptTemplate(processor, prompt, args.instruction_first)
+    if args.benchmark_prefill:
+        benchmark_prefill(model, processor, template, image_files, args.benchmark_batch_sizes)
         return
 
-    # Process images in batches
-    with open(OUTPUT_FILE, "w") as f:
-        for i in tqdm(range(0, len(image_files), BATCH_SIZE), desc="Processing batches"):
-            batch_paths = image_files[i:i + BATCH_SIZE]
-            try:
-                captions = generate_captions_batch(model, processor, batch_paths)
-                for image_path, caption in zip(batch_paths, captions):
-                    entry = create_metadata_entry(image_path, caption)
-                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
-                f.flush()
-            except Exception as e:
-                logger.error(f"Error processing batch starting at {batch_paths[0].name}: {e}")
-                # Fallback: process individually
-                for image_path in batch_paths:
-                    try:
-                        captions = generate_captions_batch(model, processor, [image_path])
-                        entry = create_metadata_entry(image_path, captions[0])
-                        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
-                        f.flush()
-                    except Exception as e2:
-                        logger.error(f"Error processing {image_path.name}: {e2}")
-                        continue
-
-    print(f"\nMetadata saved to {OUTPUT_FILE}")
+    # Batch by predicted sequence length; image sizes come from the headers only
+    # Replicas run at the same time and each only probes its own shard, so they must not share one index file
+    size_index_path = args.size_index or args.image_dir / ".caption_image_sizes.json"
+    if args.shard is not None:
+        size_index_path = shard_output_path(size_index_path, *args.shard)
+    size_index = ImageSizeIndex(args.image_dir, suffix="", index_path=size_index_path)
+    sequence_lengths = [len(template) + predict_vision_tokens(size_index.get(path.name)) for path in image_files]
+    size_index.save()
+    batcher = TokenBudgetBatcher(image_files, sequence_lengths, args.token_budget, args.max_batch_size)
+
+    # With --resume every batch is appended and fsynced, otherwise the output appears atomically once all batches are done
+    pool = PinnedBufferPool(args.prefetch_batches + 2) if torch.cuda.is_available() else None
+    profiler = BatchProfiler() if args.profile else None
+    with JsonlWriter(output_file, append=args.resume) as writer, tqdm(total=len(image_files), unit="img", desc="Captioning") as progress:
+        writer.write_batch(cached_entries)
+        for batch_paths, prepared in iter_prepared_batches(processor, batcher, template, args.preprocess_workers, args.prefetch_batches, pool):
+            entries = caption_batch(model, processor, batch_paths, template, prepared, batcher, pool, profiler)
+            writer.write_batch(entries)
+            if cache is not None:
+                cache.put_many({cache_keys[entry["file_name"]]: entry["caption"] for entry in entries})
+            progress.update(len(batch_paths))
+    # Entries are written in cache-hit and batch order; sort them like get_image_files
+    sort_jsonl([output_file], output_file)
+    if profiler is not None:
+        logger.info(f"Profile: {profiler.summary()}")
+    if cache is not None:
+        logger.info(f"Caption cache: {cache.stats()}")
+        cache.close()
+
+    print(f"\nMetadata saved to {output_file}")
 
 
 if __name__ == "__main__":
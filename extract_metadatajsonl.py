@@ -1,90 +1,150 @@
+import argparse
 import json
+import logging
 from pathlib import Path
-import math
-from dataclasses import dataclass
-from pathlib import Path
-from PIL import Image
+
+import numpy as np
 from tqdm import tqdm
-from utils.vis import to_overlay_image
-import shutil
-from logging import getLogger
-logger = getLogger(__name__)
-
-@dataclass 
-class LabelLine:
-    class_id: int
-    x_center: float
-    y_center: float
-    width: float
-    height: float
-
-def read_label_line(line: str):
-    parts = line.split()
-    class_id = int(parts[0])
-    x_center = float(parts[1])
-    y_center = float(parts[2])
-    width = float(parts[3])
-    height = float(parts[4])
-    return LabelLine(class_id, x_center, y_center, width, height)
-
-def read_label_file(label_file: Path) -> list[LabelLine]:
-    with label_file.open("r") as f:
-        labels = [read_label_line(line) for line in f]
-        
-    return labels
-
-def read_labels_dir(labels_dir: Path) -> dict[str, list[LabelLine]]:
-
-    # load labels
-    labels = {}
-    for label_file in tqdm(list(labels_dir.glob("*.txt"))):
-        labels[label_file.stem] = read_label_file(label_file)
-    return labels
-
-def convert_caption_list_to_dict(caption_list):
-    caption_dict = {}
-    for caption in caption_list:
-        caption_dict[caption["image_id"]] = caption
-    return caption_dict
-
-
-captions_json_fpath = "/home/azureuser/ControlFinetuningSandbox/data/coco2014/captions/raw/annotations_trainval2014/annotations/captions_train2014.json"
-output_jsonl_fpath = "./metadata_vehicle_only_coco14.jsonl"
+
+from generate_conditions import LabelArrays, read_labels_dir
+from metadata_io import JsonlWriter
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+logger = logging.getLogger(__name__)
+
+CAPTION_POLICIES = ("first", "last", "longest", "all")
+
+captions_json_fpath = Path("/home/azureuser/ControlFinetuningSandbox/data/coco2014/captions/raw/annotations_trainval2014/annotations/captions_train2014.json")
+output_jsonl_fpath = Path("./metadata_vehicle_only_coco14.jsonl")
 raw_bbox_labels_folder_fpath = Path("/home/azureuser/ControlFinetuningSandbox/data/coco2014/labels/train2014")
 exclude_bbox_categories = [0] + list(range(9, 80))
 max_num_bboxes = 5
 
 
-captions = json.load(open(captions_json_fpath))
-captions_dict = convert_caption_list_to_dict(captions["annotations"])
-metadata_jsonl = []
-for image_metadata in captions["images"]:
-    image_id = image_metadata["id"]
-    caption = captions_dict[image_id]["caption"]
-    image_fname = image_metadata["file_name"]
-    image_stem = str(Path(image_fname).stem)
-    condition_fname = image_stem + "_condition.png"
-
-    bbox_annotations_filepath = raw_bbox_labels_folder_fpath / f"{image_stem}.txt"
-    if not bbox_annotations_filepath.exists():
-        logger.warning(f"Bbox annotations not found for image {image_stem}")
-        continue
-    assert bbox_annotations_filepath.exists(), f"Bbox annotations not found for image {image_stem}"
-    bbox_annotations = read_label_file(bbox_annotations_filepath)
-    is_exclude = False
-    for bbox_annotation in bbox_annotations:
-        if bbox_annotation.class_id in exclude_bbox_categories:
-            is_exclude = True
-    
-    if len(bbox_annotations) > max_num_bboxes:
-        continue
-    if is_exclude:
-        continue
-
-
-    metadata_jsonl.append(
-        {"file_name": image_fname, "condition": condition_fname, "caption": caption}
-    )
-with open(output_jsonl_fpath, "w") as f:
-    for metadata in metadata_jsonl:
-        f.write(json.dumps(metadata) + "\n")
+def iter_coco_items(captions_json_fpath: Path, key: str):
+    """Yield the entries of a top-level COCO array ("images" or "annotations").
+
+    Streams the file with ijson when it is installed, so only one entry is in
+    memory at a time; otherwise falls back to loading the whole file.
+    """
+    with open(captions_json_fpath, "rb") as f:
+        if ijson is not None:
+            yield from ijson.items(f, f"{key}.item", use_float=True)
+        else:
+            yield from json.load(f)[key]
+
+
+def coco_arrays(captions_json_fpath: Path, keys) -> dict:
+    """Iterables over several top-level COCO arrays.
+
+    With ijson each array is streamed by its own iter_coco_items pass;
+    without it the file is loaded once and all arrays come from that load.
+    """
+    if ijson is not None:
+        return {key: iter_coco_items(captions_json_fpath, key) for key in keys}
+    with open(captions_json_fpath, "rb") as f:
+        document = json.load(f)
+    return {key: document[key] for key in keys}
+
+
+def collect_captions(annotations) -> dict[int, list[str]]:
+    """Map image id to all of its captions, in file order.
+
+    Args:
+        annotations: COCO caption annotations, e.g. from coco_arrays.
+    """
+    captions = {}
+    for annotation in annotations:
+        captions.setdefault(annotation["image_id"], []).append(annotation["caption"])
+    return captions
+
+
+def select_caption(captions: list[str], policy: str = "last"):
+    """Pick the caption(s) of one image according to a CAPTION_POLICIES policy."""
+    if policy == "first":
+        return captions[0]
+    if policy == "last":
+        return captions[-1]
+    if policy == "longest":
+        return max(captions, key=len)
+    if policy == "all":
+        return list(captions)
+    raise ValueError(f"Unknown caption policy {policy!r}, expected one of {CAPTION_POLICIES}")
+
+
+def eligible_label_stems(labels: LabelArrays, exclude_bbox_categories, max_num_bboxes: int) -> set[str]:
+    """Stems whose labels have at most max_num_bboxes boxes and none of the excluded categories."""
+    counts = np.diff(labels.offsets)
+    excluded_boxes = np.isin(labels.class_ids, np.asarray(list(exclude_bbox_categories), dtype=labels.class_ids.dtype))
+    # Images with an excluded box; reduceat is wrong for empty groups, so they are masked out
+    has_excluded = np.zeros(len(counts), dtype=bool)
+    non_empty = counts > 0
+    if len(excluded_boxes):
+        has_excluded[non_empty] = np.logical_or.reduceat(excluded_boxes, labels.offsets[:-1][non_empty])
+    keep = (counts <= max_num_bboxes) & ~has_excluded
+    return {stem for stem, is_kept in zip(labels.stems, keep.tolist()) if is_kept}
+
+
+def build_metadata(
+    captions_json_fpath: Path,
+    raw_bbox_labels_folder_fpath: Path,
+    exclude_bbox_categories=exclude_bbox_categories,
+    max_num_bboxes: int = max_num_bboxes,
+    caption_policy: str = "last",
+):
+    """Yield metadata entries for the COCO images whose labels pass the bbox filters.
+
+    Images without a label file or without captions are skipped with a
+    warning; entries follow the order of the "images" array.
+    """
+    labels = read_labels_dir(raw_bbox_labels_folder_fpath)
+    eligible_stems = eligible_label_stems(labels, exclude_bbox_categories, max_num_bboxes)
+    coco = coco_arrays(captions_json_fpath, ("annotations", "images"))
+    captions = collect_captions(coco.pop("annotations"))
+
+    for image_metadata in coco.pop("images"):
+        image_fname = image_metadata["file_name"]
+        image_stem = Path(image_fname).stem
+        if image_stem not in labels:
+            logger.warning(f"Bbox annotations not found for image {image_stem}")
+            continue
+        if image_stem not in eligible_stems:
+            continue
+        image_captions = captions.get(image_metadata["id"])
+        if not image_captions:
+            logger.warning(f"No captions found for image {image_stem}")
+            continue
+        yield {
+            "file_name": image_fname,
+            "condition": image_stem + "_condition.png",
+            "caption": select_caption(image_captions, caption_policy),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Join COCO captions with YOLO labels into a metadata JSONL file.")
+    parser.add_argument("--captions-json", type=Path, default=captions_json_fpath)
+    parser.add_argument("--labels-dir", type=Path, default=raw_bbox_labels_folder_fpath)
+    parser.add_argument("--output", type=Path, default=output_jsonl_fpath)
+    parser.add_argument("--exclude-categories", type=int, nargs="*", default=exclude_bbox_categories, help="Skip images with any of these class ids")
+    parser.add_argument("--max-num-bboxes", type=int, default=max_num_bboxes, help="Skip images with more boxes")
+    parser.add_argument("--caption-policy", choices=CAPTION_POLICIES, default="last", help="Which caption(s) to keep per image; 'all' writes a list")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+
+    with JsonlWriter(args.output) as writer:
+        writer.write_many(
+            tqdm(
+                build_metadata(args.captions_json, args.labels_dir, args.exclude_categories, args.max_num_bboxes, args.caption_policy),
+                desc="Writing metadata",
+            )
+        )
+    logger.info(f"Wrote {writer.count} entries to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,8 @@
-import json
 from pathlib import Path
 import os
 
+from metadata_io import JsonlWriter
+
 base_dir = Path("/home/azureuser/data/img_selection/selection")
 
 dismiss_dir = base_dir / "dismiss"
@@ -29,9 +30,8 @@ if mid_dir.exists():
     for filename in mid_dir.iterdir():
         image_files.append("mid/" + filename.name)
 
-with open(output_file, "w") as f:
+with JsonlWriter(output_file) as writer:
     for img_name in sorted(image_files):
-        data = {"img_name": img_name, "prompt": "_"}
-        f.write(json.dumps(data) + "\n")
+        writer.write({"img_name": img_name, "prompt": "_"})
 
 print(f"Generated {output_file} with {len(image_files)} entries.")
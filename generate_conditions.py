@@ -1,10 +1,22 @@
+import argparse
+import hashlib
+import io
+import json
 import math
-from dataclasses import dataclass
+import os
+import time
+from collections.abc import Mapping
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from dataclasses import asdict, dataclass
+from functools import lru_cache
 from pathlib import Path
+import numpy as np
 from PIL import Image
+from image_probe import ImageSizeIndex, probe_image_size
 from tqdm import tqdm
-from utils.vis import to_overlay_image
 import shutil
+import logging
+logger = logging.getLogger(__name__)
 
 @dataclass 
 class LabelLine:
@@ -29,198 +41,856 @@ def read_label_file(label_file: Path) -> list[LabelLine]:
         
     return labels
 
-def read_labels_dir(labels_dir: Path) -> dict[str, list[LabelLine]]:
+class LabelArrays(Mapping):
+    """Structure-of-arrays store for the YOLO labels of a directory.
 
-    # load labels
-    labels = {}
-    for label_file in tqdm(list(labels_dir.glob("*.txt"))):
-        labels[label_file.stem] = read_label_file(label_file)
-    return labels
+    Boxes of all files are kept in flat arrays; the boxes of ``stems[i]`` are
+    rows ``offsets[i]:offsets[i + 1]``. Indexing by stem builds the
+    ``list[LabelLine]`` on demand, so this can be used wherever a
+    ``dict[str, list[LabelLine]]`` is expected.
 
-def generate_image_from_label(label: list[LabelLine], image_size: tuple[int, int]) -> Image.Image:
-    """Generate a grayscale image with white bounding-box outlines from YOLO labels.
+    Attributes:
+        stems: Label file stems, sorted.
+        class_ids: (N,) int16 class ids.
+        boxes: (N, 4) float32 (x_center, y_center, width, height), normalized.
+        offsets: (len(stems) + 1,) int64 row offsets per file.
+    """
+
+    def __init__(self, stems: list[str], class_ids: np.ndarray, boxes: np.ndarray, offsets: np.ndarray):
+        self.stems = list(stems)
+        self.class_ids = class_ids
+        self.boxes = boxes
+        self.offsets = offsets
+        self._positions = {stem: i for i, stem in enumerate(self.stems)}
+
+    def arrays(self, stem: str) -> tuple[np.ndarray, np.ndarray]:
+        """Return (class_ids, boxes) views for one label file."""
+        i = self._positions[stem]
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        return self.class_ids[start:stop], self.boxes[start:stop]
+
+    def __getitem__(self, stem: str) -> list[LabelLine]:
+        class_ids, boxes = self.arrays(stem)
+        return [
+            LabelLine(class_id, x_center, y_center, width, height)
+            for class_id, (x_center, y_center, width, height) in zip(class_ids.tolist(), boxes.tolist())
+        ]
+
+    def __iter__(self):
+        return iter(self.stems)
+
+    def __len__(self) -> int:
+        return len(self.stems)
+
+    def __contains__(self, stem) -> bool:
+        return stem in self._positions
+
+    def save(self, path: Path, fingerprint: str = "") -> None:
+        """Write all arrays to a single .npz file (atomically)."""
+        tmp_path = path.with_name(path.name + ".tmp.npz")
+        np.savez(
+            tmp_path,
+            stems=np.array(self.stems, dtype=str),
+            class_ids=self.class_ids,
+            boxes=self.boxes,
+            offsets=self.offsets,
+            fingerprint=np.array(fingerprint),
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Path, fingerprint: str | None = None) -> "LabelArrays | None":
+        """Load arrays written by save(), or None if missing or the fingerprint differs."""
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                if fingerprint is not None and str(data["fingerprint"]) != fingerprint:
+                    return None
+                return cls(data["stems"].tolist(), data["class_ids"], data["boxes"], data["offsets"])
+        except (OSError, KeyError, ValueError):
+            return None
+
+
+LABELS_CACHE_NAME = ".labels_cache.npz"
+
+
+def _labels_dir_fingerprint(label_entries: list[os.DirEntry]) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    for entry in label_entries:
+        stat = entry.stat()
+        digest.update(f"{entry.name}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+def _parse_label_batch(label_paths: list[str]) -> tuple[list[int], np.ndarray]:
+    """Read a batch of label files; return per-file box counts and all values as (n, 5).
+
+    Like read_label_line, each line contributes its first five tokens and any
+    further tokens (e.g. segment coordinates) are ignored; blank lines are skipped.
+    """
+    counts = []
+    tokens = []
+    for label_path in label_paths:
+        with open(label_path, "rb") as f:
+            lines = [line.split() for line in f.read().splitlines()]
+        lines = [line for line in lines if line]
+        if any(len(line) < 5 for line in lines):
+            raise ValueError(f"Malformed YOLO label file (line with fewer than 5 values): {label_path}")
+        counts.append(len(lines))
+        for line in lines:
+            tokens.extend(line[:5])
+    return counts, np.array(tokens, dtype=np.float64).reshape(-1, 5)
+
+
+def read_labels_dir(labels_dir: Path, num_threads: int = 16, use_cache: bool = True, files_per_batch: int = 512) -> LabelArrays:
+    """Read all YOLO label files of a directory into a LabelArrays store.
+
+    The directory is listed once; files are read in batches on a thread pool
+    and parsed with NumPy. The result is cached in ``labels_dir/.labels_cache.npz``,
+    keyed on the names, sizes and mtimes of the label files, so unchanged
+    directories load without opening any label file.
 
     Args:
-        label: List of LabelLine entries with normalized coordinates.
-        image_size: (width, height) in pixels.
+        labels_dir: Directory with ``*.txt`` YOLO label files.
+        num_threads: Threads used to read files.
+        use_cache: Read and write the .npz cache (skipped if the directory is read-only).
+        files_per_batch: Files read and parsed per thread task.
 
     Returns:
-        PIL.Image.Image in mode "L" (black background, white box outlines).
+        LabelArrays mapping label stems to their labels.
     """
-    # Import locally to avoid changing global imports
-    from PIL import ImageDraw
+    labels_dir = Path(labels_dir)
+    with os.scandir(labels_dir) as it:
+        label_entries = sorted((entry for entry in it if entry.name.endswith(".txt") and entry.is_file()), key=lambda e: e.name)
+
+    cache_path = labels_dir / LABELS_CACHE_NAME
+    fingerprint = _labels_dir_fingerprint(label_entries) if use_cache else ""
+    if use_cache:
+        cached = LabelArrays.load(cache_path, fingerprint)
+        if cached is not None:
+            return cached
+
+    paths = [entry.path for entry in label_entries]
+    batches = [paths[i:i + files_per_batch] for i in range(0, len(paths), files_per_batch)]
+    counts: list[int] = []
+    values = []
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        with tqdm(total=len(paths), desc="Reading labels") as progress:
+            for batch_counts, batch_values in executor.map(_parse_label_batch, batches):
+                counts.extend(batch_counts)
+                values.append(batch_values)
+                progress.update(len(batch_counts))
+
+    values = np.concatenate(values) if values else np.zeros((0, 5))
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    labels = LabelArrays(
+        [Path(path).stem for path in paths],
+        values[:, 0].astype(np.int16),
+        values[:, 1:].astype(np.float32),
+        offsets,
+    )
+
+    if use_cache:
+        try:
+            labels.save(cache_path, fingerprint)
+        except OSError:
+            pass
+    return labels
+
+def _box_corners(boxes: np.ndarray, image_size: tuple[int, int]) -> tuple[np.ndarray, np.ndarray]:
+    """Convert normalized YOLO boxes to clipped integer pixel corners.
 
+    Uses the same float arithmetic and clipping as drawing each box with
+    PIL, which truncates the float corners to ints.
+
+    Returns:
+        (valid, corners): a bool mask of boxes that are non-empty after
+        clipping, and an (N, 4) int64 array of (left, top, right, bottom).
+    """
     width, height = image_size
-    # Start with a black canvas
-    img = Image.new("L", (width, height), color="#000000").convert("RGB")
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    x_center_px = boxes[:, 0] * width
+    y_center_px = boxes[:, 1] * height
+    box_w_px = boxes[:, 2] * width
+    box_h_px = boxes[:, 3] * height
 
-    if not label:
-        return img
+    left = np.clip(x_center_px - box_w_px / 2.0, 0.0, float(width - 1))
+    top = np.clip(y_center_px - box_h_px / 2.0, 0.0, float(height - 1))
+    right = np.clip(x_center_px + box_w_px / 2.0, 0.0, float(width - 1))
+    bottom = np.clip(y_center_px + box_h_px / 2.0, 0.0, float(height - 1))
 
-    draw = ImageDraw.Draw(img)
+    valid = (right > left) & (bottom > top)
+    corners = np.stack([left, top, right, bottom], axis=1).astype(np.int64)
+    return valid, corners
 
-    for item in label:
-        # Convert normalized YOLO (cx, cy, w, h) to pixel box corners
-        x_center_px = item.x_center * width
-        y_center_px = item.y_center * height
-        box_w_px = item.width * width
-        box_h_px = item.height * height
 
-        left = x_center_px - box_w_px / 2.0
-        top = y_center_px - box_h_px / 2.0
-        right = x_center_px + box_w_px / 2.0
-        bottom = y_center_px + box_h_px / 2.0
+@lru_cache(maxsize=None)
+def _category_palette() -> np.ndarray:
+    """CATEGORY_COLORS as an (n, 3) uint8 array."""
+    return np.array([[int(color[i:i + 2], 16) for i in (1, 3, 5)] for color in category_colors()], dtype=np.uint8)
 
-        # Clip to image bounds
-        left = max(0.0, min(float(width - 1), left))
-        top = max(0.0, min(float(height - 1), top))
-        right = max(0.0, min(float(width - 1), right))
-        bottom = max(0.0, min(float(height - 1), bottom))
 
-        # Skip invalid/empty boxes after clipping
-        if right <= left or bottom <= top:
-            continue
+class BoxRasterizer:
+    """Draws YOLO boxes into a reusable, preallocated uint8 buffer.
 
-        # Draw rectangle outline for visibility
-        draw.rectangle([(left, top), (right, bottom)], outline=category_to_color(item.class_id), width=2)
+    With the defaults, render() is pixel-identical to drawing every box with
+    ``ImageDraw.rectangle(..., outline=category_to_color(class_id), width=2)``
+    on a black RGB canvas: corners are clipped and truncated like PIL does,
+    and the outline is made of the same horizontal runs and end-exclusive
+    vertical runs. Boxes are drawn in order, later boxes on top.
 
-    return img
+    The buffer is reused between calls, so one rasterizer can render many
+    label sets of the same resolution (see render_batch) without allocating.
 
-def _lab_to_xyz(l: float, a: float, b: float) -> tuple[float, float, float]:
-    fy = (l + 16.0) / 116.0
-    fx = fy + a / 500.0
-    fz = fy - b / 200.0
-    delta = 6.0 / 29.0
+    Args:
+        image_size: (width, height) in pixels.
+        stroke_width: Outline width in pixels; 0 draws no outline.
+        fill: Also fill the box interior with its color.
+        fill_alpha: Opacity of the fill, blended over what is already drawn.
+        palette: Colors indexed by class id, (n, channels) uint8 for color
+            output or (n,) uint8 for single-channel (e.g. palette index)
+            output. Defaults to CATEGORY_COLORS.
+    """
+
+    def __init__(
+        self,
+        image_size: tuple[int, int],
+        stroke_width: int = 2,
+        fill: bool = False,
+        fill_alpha: float = 1.0,
+        palette: np.ndarray | None = None,
+    ):
+        self.image_size = image_size
+        self.stroke_width = stroke_width
+        self.fill = fill
+        self.fill_alpha = fill_alpha
+        self.palette = _category_palette() if palette is None else np.asarray(palette, dtype=np.uint8)
+        width, height = image_size
+        self.buffer = np.zeros((height, width, *self.palette.shape[1:]), dtype=np.uint8)
+
+    def render(self, class_ids: np.ndarray, boxes: np.ndarray) -> np.ndarray:
+        """Clear the buffer and draw one label set into it.
+
+        Args:
+            class_ids: (N,) class ids, indexing the palette.
+            boxes: (N, 4) normalized (x_center, y_center, width, height).
+
+        Returns:
+            The internal buffer, (height, width[, channels]) uint8. It is
+            overwritten by the next call.
+        """
+        class_ids = np.asarray(class_ids, dtype=np.int64)
+        assert ((class_ids >= 0) & (class_ids < len(self.palette))).all()
+
+        self.buffer.fill(0)
+        valid, corners = _box_corners(boxes, self.image_size)
+        colors = self.palette[class_ids]
+        for (left, top, right, bottom), color in zip(corners[valid].tolist(), colors[valid]):
+            if self.fill:
+                self._fill(left, top, right, bottom, color)
+            if self.stroke_width > 0:
+                self._outline(left, top, right, bottom, color)
+        return self.buffer
+
+    def render_batch(self, label_sets):
+        """Render (class_ids, boxes) pairs one after another into the same buffer.
+
+        Yields:
+            The buffer after each label set; copy it to keep it.
+        """
+        for class_ids, boxes in label_sets:
+            yield self.render(class_ids, boxes)
+
+    def _paint(self, rows: tuple[int, int], cols: tuple[int, int], color: np.ndarray) -> None:
+        height, width = self.buffer.shape[:2]
+        row_start, row_stop = max(rows[0], 0), min(rows[1], height)
+        col_start, col_stop = max(cols[0], 0), min(cols[1], width)
+        if row_start < row_stop and col_start < col_stop:
+            self.buffer[row_start:row_stop, col_start:col_stop] = color
+
+    def _fill(self, left: int, top: int, right: int, bottom: int, color: np.ndarray) -> None:
+        if self.fill_alpha >= 1.0:
+            self._paint((top, bottom + 1), (left, right + 1), color)
+            return
+        region = self.buffer[top:bottom + 1, left:right + 1]
+        blended = region * (1.0 - self.fill_alpha) + color.astype(np.float64) * self.fill_alpha
+        region[...] = np.rint(blended).astype(np.uint8)
+
+    def _outline(self, left: int, top: int, right: int, bottom: int, color: np.ndarray) -> None:
+        stroke = self.stroke_width
+        # Horizontal runs: the first and last `stroke` rows, full box width
+        self._paint((top, top + stroke), (left, right + 1), color)
+        self._paint((bottom - stroke + 1, bottom + 1), (left, right + 1), color)
+        # Vertical runs: PIL draws them from top + stroke towards bottom - stroke + 1,
+        # excluding the end point, which may run upwards on very small boxes
+        start, end = top + stroke, bottom - stroke + 1
+        rows = (start, end) if start <= end else (end + 1, start + 1)
+        self._paint(rows, (left, left + stroke), color)
+        self._paint(rows, (right - stroke + 1, right + 1), color)
+
+
+def _label_lines_to_arrays(label: list[LabelLine]) -> tuple[np.ndarray, np.ndarray]:
+    class_ids = np.array([item.class_id for item in label], dtype=np.int64)
+    boxes = np.array([(item.x_center, item.y_center, item.width, item.height) for item in label], dtype=np.float64).reshape(-1, 4)
+    return class_ids, boxes
+
+
+def generate_image_from_label(label: list[LabelLine], image_size: tuple[int, int]) -> Image.Image:
+    """Generate an RGB image with colored bounding-box outlines from YOLO labels.
+
+    Args:
+        label: List of LabelLine entries with normalized coordinates.
+        image_size: (width, height) in pixels.
+
+    Returns:
+        PIL.Image.Image in mode "RGB" (black background, box outlines colored by category).
+    """
+    buffer = BoxRasterizer(image_size).render(*_label_lines_to_arrays(label))
+    return Image.fromarray(buffer, "RGB")
 
-    def f_inv(t: float) -> float:
-        if t > delta:
-            return t ** 3
-        return 3.0 * delta * delta * (t - 4.0 / 29.0)
+PALETTE_VERSION = 1
+# (lightness, chroma) rings in LCH space that palette candidates are sampled from
+PALETTE_RINGS = ((60.0, 40.0), (70.0, 50.0), (80.0, 35.0), (65.0, 45.0))
+PALETTE_HUE_STEP = 3.0
+NUM_CATEGORY_COLORS = 80
 
-    x = 0.95047 * f_inv(fx)
-    y = 1.00000 * f_inv(fy)
-    z = 1.08883 * f_inv(fz)
-    return x, y, z
 
+def _lch_to_lab(lch: np.ndarray) -> np.ndarray:
+    h = np.radians(lch[:, 2] % 360.0)
+    return np.stack([lch[:, 0], lch[:, 1] * np.cos(h), lch[:, 1] * np.sin(h)], axis=1)
 
-def _xyz_to_linear_rgb(x: float, y: float, z: float) -> tuple[float, float, float]:
+
+def _lab_to_xyz(lab: np.ndarray) -> np.ndarray:
+    fy = (lab[:, 0] + 16.0) / 116.0
+    f = np.stack([fy + lab[:, 1] / 500.0, fy, fy - lab[:, 2] / 200.0], axis=1)
+    delta = 6.0 / 29.0
+    f_inv = np.where(f > delta, f ** 3, 3.0 * delta * delta * (f - 4.0 / 29.0))
+    return f_inv * np.array([0.95047, 1.00000, 1.08883])
+
+
+def _xyz_to_linear_rgb(xyz: np.ndarray) -> np.ndarray:
+    x, y, z = xyz[:, 0], xyz[:, 1], xyz[:, 2]
     r = 3.2404542 * x - 1.5371385 * y - 0.4985314 * z
     g = -0.9692660 * x + 1.8760108 * y + 0.0415560 * z
     b = 0.0556434 * x - 0.2040259 * y + 1.0572252 * z
-    return r, g, b
+    return np.stack([r, g, b], axis=1)
 
 
-def _linear_to_srgb(value: float) -> float:
-    if value <= 0.0031308:
-        return 12.92 * value
-    return 1.055 * (value ** (1 / 2.4)) - 0.055
+def _linear_to_srgb(value: np.ndarray) -> np.ndarray:
+    return np.where(value <= 0.0031308, 12.92 * value, 1.055 * (np.maximum(value, 0.0) ** (1 / 2.4)) - 0.055)
 
 
-def _lab_to_rgb(l: float, a: float, b: float):
-    x, y, z = _lab_to_xyz(l, a, b)
-    r_lin, g_lin, b_lin = _xyz_to_linear_rgb(x, y, z)
+def _lab_to_rgb(lab: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Convert Lab colors to 8-bit sRGB.
 
-    if min(r_lin, g_lin, b_lin) < -0.001 or max(r_lin, g_lin, b_lin) > 1.001:
-        return None
+    Returns:
+        (in_gamut, rgb): a mask of colors inside the sRGB gamut (with a small
+        tolerance) and their (N, 3) int rgb values.
+    """
+    linear_rgb = _xyz_to_linear_rgb(_lab_to_xyz(lab))
+    in_gamut = (linear_rgb.min(axis=1) >= -0.001) & (linear_rgb.max(axis=1) <= 1.001)
+    srgb = _linear_to_srgb(np.clip(linear_rgb, 0.0, 1.0))
+    return in_gamut, np.rint(srgb * 255).astype(np.int64)
 
-    r_lin = min(max(r_lin, 0.0), 1.0)
-    g_lin = min(max(g_lin, 0.0), 1.0)
-    b_lin = min(max(b_lin, 0.0), 1.0)
 
-    r = _linear_to_srgb(r_lin)
-    g = _linear_to_srgb(g_lin)
-    b = _linear_to_srgb(b_lin)
+def _build_palette_candidates(rings=PALETTE_RINGS, hue_step: float = PALETTE_HUE_STEP) -> tuple[np.ndarray, np.ndarray]:
+    """Sample distinct in-gamut candidates along the LCH rings, ring by ring.
 
-    return int(round(r * 255)), int(round(g * 255)), int(round(b * 255))
+    Returns:
+        (lab, rgb) arrays of shape (N, 3).
+    """
+    hues = np.arange(0.0, 360.0, hue_step)
+    lch = np.array([(l, c, h) for l, c in rings for h in hues], dtype=np.float64)
+    lab = _lch_to_lab(lch)
+    in_gamut, rgb = _lab_to_rgb(lab)
+    lab, rgb = lab[in_gamut], rgb[in_gamut]
+    # Fine hue grids map neighbouring candidates to the same 8-bit color; keep the first one
+    _, first = np.unique(rgb, axis=0, return_index=True)
+    first.sort()
+    return lab[first], rgb[first]
+
+
+def _select_farthest_points(points: np.ndarray, size: int) -> np.ndarray:
+    """Greedy farthest-point selection starting from the first point.
+
+    Keeps the distance of every point to its nearest selected point and
+    updates it with the newly selected point only, so each step is O(N).
+    The symmetric hue grid produces many (near) ties; contenders within
+    rounding error of the best are re-ranked with math.dist and ties go to
+    the lowest index, which reproduces the original pure-Python search.
+    """
+    if size > len(points):
+        raise RuntimeError("Unable to devise a palette of the requested size.")
+    selected = np.empty(size, dtype=np.int64)
+    selected[0] = 0
+    min_distance = np.full(len(points), np.inf)
+    point_tuples = [tuple(point) for point in points.tolist()]
+    for i in range(1, size):
+        distance = np.sqrt(((points - points[selected[i - 1]]) ** 2).sum(axis=1))
+        np.minimum(min_distance, distance, out=min_distance)
+        min_distance[selected[i - 1]] = -np.inf
+        best = min_distance.max()
+        contenders = np.flatnonzero(min_distance >= best - 1e-9 * max(best, 1.0))
+        if len(contenders) > 1:
+            selected_so_far = selected[:i]
+            distances = np.sqrt(((points[contenders, None] - points[None, selected_so_far]) ** 2).sum(axis=2))
+            nearest = distances <= distances.min(axis=1, keepdims=True) + 1e-9 * max(best, 1.0)
+            exact = [
+                min(math.dist(point_tuples[j], point_tuples[k]) for k in selected_so_far[row].tolist())
+                for j, row in zip(contenders.tolist(), nearest)
+            ]
+            selected[i] = contenders[int(np.argmax(exact))]
+        else:
+            selected[i] = contenders[0]
+    return selected
+
+
+def _palette_cache_path(size: int, rings, hue_step: float) -> Path:
+    key = json.dumps([PALETTE_VERSION, size, [list(ring) for ring in rings], hue_step])
+    digest = hashlib.blake2b(key.encode(), digest_size=8).hexdigest()
+    cache_home = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache")
+    return cache_home / "werkzeug" / "palettes" / f"palette-{size}-{digest}.json"
+
+
+def _generate_distinct_palette(size: int, rings=PALETTE_RINGS, hue_step: float | None = None) -> list[str]:
+    """Pick ``size`` perceptually distinct colors as ``#RRGGBB`` strings.
+
+    Without an explicit ``hue_step`` the hue grid starts at PALETTE_HUE_STEP
+    and is halved until there are enough candidates, so large taxonomies get
+    a palette too while the first 80 colors stay the same.
+    """
+    if hue_step is None:
+        hue_step = PALETTE_HUE_STEP
+        while len(_build_palette_candidates(rings, hue_step)[0]) < size:
+            hue_step /= 2
+    lab, rgb = _build_palette_candidates(rings, hue_step)
+    selected = _select_farthest_points(lab, size)
+    return [f"#{r:02X}{g:02X}{b:02X}" for r, g, b in rgb[selected].tolist()]
 
 
-def _lch_to_lab(l: float, c: float, h_degrees: float) -> tuple[float, float, float]:
-    h = math.radians(h_degrees % 360.0)
-    a = c * math.cos(h)
-    b = c * math.sin(h)
-    return l, a, b
+@lru_cache(maxsize=None)
+def distinct_palette(size: int, rings=PALETTE_RINGS, hue_step: float | None = None) -> tuple[str, ...]:
+    """Cached _generate_distinct_palette, memoized on disk under ``$XDG_CACHE_HOME/werkzeug/palettes``.
 
+    Args:
+        size: Number of colors.
+        rings: (lightness, chroma) LCH rings to sample candidates from.
+        hue_step: Hue spacing of the candidates in degrees, chosen automatically if None.
 
-def _rgb_tuple_to_hex(rgb: tuple[int, int, int]) -> str:
-    r, g, b = rgb
-    return f"#{r:02X}{g:02X}{b:02X}"
+    Returns:
+        Tuple of ``#RRGGBB`` colors.
+    """
+    cache_path = _palette_cache_path(size, rings, hue_step)
+    try:
+        with open(cache_path, "r") as f:
+            return tuple(json.load(f))
+    except (OSError, ValueError):
+        pass
 
+    palette = _generate_distinct_palette(size, rings, hue_step)
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(palette, f)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logger.debug(f"Could not cache palette at {cache_path}: {e}")
+    return tuple(palette)
 
-def _build_palette_candidates() -> list[tuple[tuple[float, float, float], tuple[int, int, int]]]:
-    candidates: list[tuple[tuple[float, float, float], tuple[int, int, int]]] = []
-    for l, c in ((60.0, 40.0), (70.0, 50.0), (80.0, 35.0), (65.0, 45.0)):
-        for h in range(0, 360, 3):
-            lab = _lch_to_lab(l, c, h)
-            rgb = _lab_to_rgb(*lab)
-            if rgb is None:
-                continue
-            candidates.append((lab, rgb))
-    if len(candidates) < 80:
-        raise RuntimeError("Insufficient palette candidates to cover requested categories.")
-    return candidates
-
-
-def _generate_distinct_palette(size: int) -> list[str]:
-    candidates = _build_palette_candidates()
-    selected_indices: set[int] = set()
-    selected_labs: list[tuple[float, float, float]] = []
-    selected_rgbs: list[tuple[int, int, int]] = []
-
-    initial_index = 0
-    selected_indices.add(initial_index)
-    selected_labs.append(candidates[initial_index][0])
-    selected_rgbs.append(candidates[initial_index][1])
-
-    while len(selected_rgbs) < size:
-        best_index = None
-        best_distance = -1.0
-        for idx, (lab, _rgb) in enumerate(candidates):
-            if idx in selected_indices:
-                continue
-            min_distance = min(
-                math.dist(lab, existing_lab) for existing_lab in selected_labs
-            )
-            if min_distance > best_distance:
-                best_distance = min_distance
-                best_index = idx
-        if best_index is None:
-            raise RuntimeError("Unable to devise a palette of the requested size.")
-        selected_indices.add(best_index)
-        selected_labs.append(candidates[best_index][0])
-        selected_rgbs.append(candidates[best_index][1])
 
-    return [_rgb_tuple_to_hex(rgb) for rgb in selected_rgbs]
+def category_colors() -> tuple[str, ...]:
+    """The category palette, generated (or loaded from the disk cache) on first use."""
+    return distinct_palette(NUM_CATEGORY_COLORS)
 
 
-CATEGORY_COLORS = _generate_distinct_palette(80)
+def __getattr__(name: str):
+    # CATEGORY_COLORS is resolved lazily so importing the module does not build the palette
+    if name == "CATEGORY_COLORS":
+        return list(category_colors())
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def category_to_color(category: int) -> str:
-    assert 0 <= category < len(CATEGORY_COLORS)
-    return CATEGORY_COLORS[category]
+    colors = category_colors()
+    assert 0 <= category < len(colors)
+    return colors[category]
 
 
-def generate_cond_img(raw_images_dir: Path, label_stem: str, label_lines: list[LabelLine], output_dir: Path):
+CONDITION_FORMATS = ("png", "palette-png", "webp")
+
+
+@dataclass(frozen=True)
+class ConditionEncoder:
+    """How condition images are encoded on disk.
+
+    ``palette-png`` renders class_id + 1 into a single-channel buffer and
+    stores it as an indexed PNG whose palette is black followed by
+    CATEGORY_COLORS. It decodes to the same RGB pixels as ``png`` but is a
+    fraction of the size and much faster to compress. ``webp`` is lossless.
+
+    Args:
+        format: One of CONDITION_FORMATS.
+        compress_level: zlib level for PNG output (0-9, lower is faster).
+        webp_method: WebP effort (0-6, lower is faster).
+    """
+
+    format: str = "png"
+    compress_level: int = 6
+    webp_method: int = 4
+
+    def __post_init__(self):
+        if self.format not in CONDITION_FORMATS:
+            raise ValueError(f"Unknown condition format {self.format!r}, expected one of {CONDITION_FORMATS}")
+
+    @property
+    def suffix(self) -> str:
+        return ".webp" if self.format == "webp" else ".png"
+
+    @property
+    def indexed(self) -> bool:
+        return self.format == "palette-png"
+
+    def to_image(self, buffer: np.ndarray) -> Image.Image:
+        if not self.indexed:
+            return Image.fromarray(buffer, "RGB")
+        image = Image.fromarray(buffer, "P")
+        image.putpalette(_indexed_palette())
+        return image
+
+    def encode(self, buffer: np.ndarray) -> bytes:
+        """Encode a rendered buffer to the bytes of an image file."""
+        out = io.BytesIO()
+        image = self.to_image(buffer)
+        if self.format == "webp":
+            image.save(out, format="WEBP", lossless=True, method=self.webp_method)
+        else:
+            image.save(out, format="PNG", compress_level=self.compress_level)
+        return out.getvalue()
+
+
+@dataclass
+class EncodeStats:
+    """Size and encode time of one written condition image."""
+
+    bytes_written: int
+    encode_seconds: float
+
+
+@lru_cache(maxsize=None)
+def _indexed_palette() -> list[int]:
+    """Flat PIL palette: index 0 is the black background, index i + 1 is class i."""
+    return [0, 0, 0] + _category_palette().ravel().tolist()
+
+
+@lru_cache(maxsize=8)
+def _rasterizer(image_size: tuple[int, int], indexed: bool = False) -> BoxRasterizer:
+    """One rasterizer (and buffer) per resolution and process; most datasets have only a few."""
+    if indexed:
+        return BoxRasterizer(image_size, palette=np.arange(1, NUM_CATEGORY_COLORS + 1, dtype=np.uint8))
+    return BoxRasterizer(image_size)
+
+
+def _reference_image_size(raw_images_dir: Path, label_stem: str) -> tuple[int, int]:
     reference_image_path = raw_images_dir / f"{label_stem}.jpg"
     if not reference_image_path.exists():
         raise FileNotFoundError(f"Reference image not found for label {label_stem}")
-    reference_image = Image.open(reference_image_path)
-    width, height = reference_image.size
-    image = generate_image_from_label(label_lines, (width, height))
-    image.save(str(output_dir / f"{label_stem}_condition.png"))
-    # overlay_image = to_overlay_image(image, reference_image)
-    #overlay_image.save(str(output_dir / f"{label_stem}_condition.png"))
-
-labels_dir = Path("/home/azureuser/ControlFinetuningSandbox/data/coco2014/labels/train2014")
-raw_images_dir = Path("/home/azureuser/ControlFinetuningSandbox/data/coco2014/images/raw_train_images")
-output_dir = Path("/home/azureuser/ControlFinetuningSandbox/data/coco2014/conditions/vehicles_only_train_2014")
-exclude_bbox_categories = [0] + list(range(9, 80))
-
-if output_dir.exists():
-    shutil.rmtree(output_dir)
-output_dir.mkdir(parents=True, exist_ok=True)
-labels = read_labels_dir(labels_dir)
-
-for idx, (label_stem, label_lines) in enumerate(tqdm(list(labels.items()))):
-    label_lines_filtered = [label_line for label_line in label_lines if label_line.class_id not in exclude_bbox_categories]
-    generate_cond_img(raw_images_dir, label_stem, label_lines_filtered, output_dir)
\ No newline at end of file
+    return probe_image_size(reference_image_path)
+
+
+def condition_path(output_dir: Path, label_stem: str, encoder: ConditionEncoder = ConditionEncoder()) -> Path:
+    """Path of the condition image for a label stem."""
+    return output_dir / f"{label_stem}_condition{encoder.suffix}"
+
+
+def write_condition(
+    class_ids: np.ndarray, boxes: np.ndarray, image_size: tuple[int, int], output_path: Path, encoder: ConditionEncoder = ConditionEncoder()
+) -> EncodeStats:
+    """Render a label set straight from its arrays and write it with the given encoder.
+
+    Returns:
+        Bytes written and the time spent encoding (excluding rendering and I/O).
+    """
+    buffer = _rasterizer(tuple(image_size), encoder.indexed).render(class_ids, boxes)
+    start = time.perf_counter()
+    data = encoder.encode(buffer)
+    encode_seconds = time.perf_counter() - start
+    with open(output_path, "wb") as f:
+        f.write(data)
+    return EncodeStats(len(data), encode_seconds)
+
+
+def generate_cond_img(
+    raw_images_dir: Path,
+    label_stem: str,
+    label_lines: list[LabelLine],
+    output_dir: Path,
+    image_size: tuple[int, int] | None = None,
+    encoder: ConditionEncoder = ConditionEncoder(),
+) -> tuple[int, int]:
+    """Render and save the condition image for one label file.
+
+    The condition has the size of the ``{label_stem}.jpg`` reference image,
+    read from its header only. Pass ``image_size`` (e.g. from an
+    ImageSizeIndex) to skip touching the reference image. The file is
+    ``{label_stem}_condition`` plus the encoder's suffix.
+
+    Returns:
+        The (width, height) the condition was rendered at.
+    """
+    if image_size is None:
+        image_size = _reference_image_size(raw_images_dir, label_stem)
+    write_condition(*_label_lines_to_arrays(label_lines), image_size, condition_path(output_dir, label_stem, encoder), encoder)
+    return image_size
+
+
+def _render_condition(
+    raw_images_dir: Path,
+    label_stem: str,
+    class_ids: np.ndarray,
+    boxes: np.ndarray,
+    output_dir: Path,
+    image_size: tuple[int, int] | None,
+    encoder: ConditionEncoder,
+) -> tuple[str, tuple[int, int] | None, EncodeStats | None, str | None]:
+    """Process pool task: render one condition image, returning an error message instead of raising."""
+    try:
+        if image_size is None:
+            image_size = _reference_image_size(raw_images_dir, label_stem)
+        stats = write_condition(class_ids, boxes, image_size, condition_path(output_dir, label_stem, encoder), encoder)
+    except Exception as e:
+        return label_stem, None, None, f"{type(e).__name__}: {e}"
+    return label_stem, image_size, stats, None
+
+
+# Bump when rendering changes in a way that alters output pixels
+RENDERER_VERSION = 1
+CONDITION_MANIFEST_NAME = ".conditions_manifest.json"
+
+
+class ConditionManifest:
+    """Tracks which condition images in an output directory are up to date.
+
+    Every output is recorded with a hash of the boxes it was rendered from
+    and a hash of the render settings (excluded categories, encoder and
+    RENDERER_VERSION). An output is current if both hashes match and the
+    file exists; everything else is re-rendered.
+
+    Args:
+        output_dir: Directory with the condition images.
+        settings: JSON-serializable render settings, see render_settings.
+        manifest_path: Where the manifest is stored, defaults to ``output_dir/.conditions_manifest.json``.
+    """
+
+    def __init__(self, output_dir: Path, settings: dict, manifest_path: Path | None = None):
+        self.output_dir = Path(output_dir)
+        self.manifest_path = Path(manifest_path) if manifest_path else self.output_dir / CONDITION_MANIFEST_NAME
+        self.settings_hash = hashlib.blake2b(json.dumps(settings, sort_keys=True).encode(), digest_size=8).hexdigest()
+        self._entries: dict[str, list[str]] = {}
+        if self.manifest_path.exists():
+            with open(self.manifest_path, "r") as f:
+                self._entries = json.load(f)
+        self._existing = {entry.name for entry in os.scandir(self.output_dir)} if self.output_dir.exists() else set()
+
+    @staticmethod
+    def label_hash(class_ids: np.ndarray, boxes: np.ndarray) -> str:
+        """Hash of the boxes a condition is rendered from."""
+        digest = hashlib.blake2b(digest_size=8)
+        digest.update(np.ascontiguousarray(class_ids, dtype=np.int16).tobytes())
+        digest.update(np.ascontiguousarray(boxes, dtype=np.float32).tobytes())
+        return digest.hexdigest()
+
+    def is_current(self, label_stem: str, label_hash: str, output_name: str) -> bool:
+        return self._entries.get(label_stem) == [label_hash, self.settings_hash] and output_name in self._existing
+
+    def record(self, label_stem: str, label_hash: str) -> None:
+        self._entries[label_stem] = [label_hash, self.settings_hash]
+
+    def discard(self, label_stem: str) -> None:
+        self._entries.pop(label_stem, None)
+
+    def collect_garbage(self, expected_names: set[str]) -> int:
+        """Delete condition images (of any format) that are not expected, e.g. because their labels were removed.
+
+        Returns:
+            The number of deleted files.
+        """
+        suffixes = tuple(f"_condition{ConditionEncoder(format).suffix}" for format in CONDITION_FORMATS)
+        removed = 0
+        for name in sorted(self._existing):
+            if name.endswith(suffixes) and name not in expected_names:
+                (self.output_dir / name).unlink(missing_ok=True)
+                self._entries.pop(name.rsplit("_condition", 1)[0], None)
+                removed += 1
+        self._existing &= expected_names
+        return removed
+
+    def save(self) -> None:
+        tmp_path = self.manifest_path.with_name(self.manifest_path.name + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self._entries, f, separators=(",", ":"))
+        os.replace(tmp_path, self.manifest_path)
+
+
+def render_settings(exclude_bbox_categories, encoder: ConditionEncoder) -> dict:
+    """Settings that affect condition pixels or files, as recorded in the manifest."""
+    return {
+        "renderer_version": RENDERER_VERSION,
+        "exclude_bbox_categories": sorted(int(category) for category in exclude_bbox_categories),
+        "encoder": asdict(encoder),
+    }
+
+
+def render_conditions(
+    labels: LabelArrays,
+    raw_images_dir: Path,
+    output_dir: Path,
+    exclude_bbox_categories: list[int] = (),
+    num_workers: int | None = None,
+    max_in_flight: int | None = None,
+    size_index: ImageSizeIndex | None = None,
+    encoder: ConditionEncoder = ConditionEncoder(),
+    stats: dict[str, EncodeStats] | None = None,
+    manifest: ConditionManifest | None = None,
+) -> list[tuple[str, str]]:
+    """Render condition images for all labels on a process pool.
+
+    At most ``max_in_flight`` images are queued at a time, so memory stays
+    bounded on large label sets. A failing image (e.g. a missing reference
+    image) is logged and reported but does not stop the other images.
+
+    Args:
+        labels: Labels to render, e.g. from read_labels_dir.
+        raw_images_dir: Directory with the ``{stem}.jpg`` reference images.
+        output_dir: Directory the ``{stem}_condition`` images are written to.
+        exclude_bbox_categories: Class ids whose boxes are not drawn.
+        num_workers: Worker processes, defaults to the number of CPUs.
+        max_in_flight: Maximum number of queued tasks, defaults to 4 per worker.
+        size_index: Reference image sizes; known sizes are passed to the
+            workers and newly probed ones are recorded and saved at the end.
+        encoder: Output format and compression settings.
+        stats: If given, filled with the EncodeStats of every written image.
+        manifest: If given, only missing or stale outputs are rendered, outputs
+            without labels are deleted and the manifest is saved at the end.
+
+    Returns:
+        (label_stem, error message) for every image that failed.
+    """
+    num_workers = num_workers or os.cpu_count()
+    max_in_flight = max_in_flight or 4 * num_workers
+    exclude_bbox_categories = np.asarray(list(exclude_bbox_categories), dtype=np.int16)
+
+    failures = []
+    pending = set()
+    total_bytes, total_encode_seconds, written = 0, 0.0, 0
+    label_hashes = {}
+
+    def collect(done):
+        nonlocal total_bytes, total_encode_seconds, written
+        for future in done:
+            label_stem, image_size, image_stats, error = future.result()
+            label_hash = label_hashes.pop(label_stem, None)
+            progress.update()
+            if error is not None:
+                logger.warning(f"Failed to render condition for {label_stem}: {error}")
+                failures.append((label_stem, error))
+                if manifest is not None:
+                    manifest.discard(label_stem)
+                continue
+            if size_index is not None:
+                size_index.record(label_stem, image_size)
+            if manifest is not None:
+                manifest.record(label_stem, label_hash)
+            if stats is not None:
+                stats[label_stem] = image_stats
+            total_bytes += image_stats.bytes_written
+            total_encode_seconds += image_stats.encode_seconds
+            written += 1
+
+    stale_stems = list(labels)
+    if manifest is not None:
+        removed = manifest.collect_garbage({condition_path(output_dir, label_stem, encoder).name for label_stem in labels})
+        for label_stem in labels:
+            label_hashes[label_stem] = manifest.label_hash(*labels.arrays(label_stem))
+        stale_stems = [
+            label_stem
+            for label_stem in labels
+            if not manifest.is_current(label_stem, label_hashes[label_stem], condition_path(output_dir, label_stem, encoder).name)
+        ]
+        logger.info(f"{len(labels) - len(stale_stems)} conditions up to date, {len(stale_stems)} to render, {removed} removed")
+
+    try:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor, tqdm(total=len(stale_stems), desc="Rendering conditions") as progress:
+            for label_stem in stale_stems:
+                class_ids, boxes = labels.arrays(label_stem)
+                keep = ~np.isin(class_ids, exclude_bbox_categories)
+                image_size = size_index.cached(label_stem) if size_index is not None else None
+                if len(pending) >= max_in_flight:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                pending.add(executor.submit(_render_condition, raw_images_dir, label_stem, class_ids[keep], boxes[keep], output_dir, image_size, encoder))
+            collect(wait(pending).done)
+    finally:
+        if size_index is not None:
+            size_index.save()
+        if manifest is not None:
+            manifest.save()
+
+    if written:
+        logger.info(
+            f"Wrote {written} {encoder.format} conditions: {total_bytes / 2**20:.1f} MiB "
+            f"({total_bytes / written / 1024:.1f} KiB/image), {1000 * total_encode_seconds / written:.2f} ms encode/image"
+        )
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render bounding-box condition images from YOLO labels.")
+    parser.add_argument("--labels-dir", type=Path, default=Path("/home/azureuser/ControlFinetuningSandbox/data/coco2014/labels/train2014"))
+    parser.add_argument("--raw-images-dir", type=Path, default=Path("/home/azureuser/ControlFinetuningSandbox/data/coco2014/images/raw_train_images"))
+    parser.add_argument("--output-dir", type=Path, default=Path("/home/azureuser/ControlFinetuningSandbox/data/coco2014/conditions/vehicles_only_train_2014"))
+    parser.add_argument("--exclude-categories", type=int, nargs="*", default=[0] + list(range(9, 80)), help="Class ids whose boxes are not drawn")
+    parser.add_argument("--num-workers", type=int, default=None, help="Worker processes (default: all CPUs)")
+    parser.add_argument("--max-in-flight", type=int, default=None, help="Maximum queued images (default: 4 per worker)")
+    parser.add_argument("--size-index", type=Path, default=None, help="Image size index file (default: RAW_IMAGES_DIR/.image_sizes.json)")
+    parser.add_argument("--format", choices=CONDITION_FORMATS, default="png", help="Output encoding; palette-png is smallest and fastest")
+    parser.add_argument("--compress-level", type=int, default=6, help="PNG zlib compression level (0-9)")
+    parser.add_argument("--webp-method", type=int, default=4, help="Lossless WebP effort (0-6)")
+    parser.add_argument("--clean", action="store_true", help="Delete the output directory and render everything instead of only stale outputs")
+    parser.add_argument("--stats-file", type=Path, default=None, help="Write per-image bytes and encode time as CSV")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+
+    if args.clean and args.output_dir.exists():
+        shutil.rmtree(args.output_dir)
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+    labels = read_labels_dir(args.labels_dir)
+
+    size_index = ImageSizeIndex(args.raw_images_dir, index_path=args.size_index)
+    encoder = ConditionEncoder(args.format, args.compress_level, args.webp_method)
+    stats = {} if args.stats_file else None
+    manifest = ConditionManifest(args.output_dir, render_settings(args.exclude_categories, encoder))
+    failures = render_conditions(
+        labels,
+        args.raw_images_dir,
+        args.output_dir,
+        args.exclude_categories,
+        args.num_workers,
+        args.max_in_flight,
+        size_index,
+        encoder,
+        stats,
+        manifest,
+    )
+    if stats is not None:
+        with open(args.stats_file, "w") as f:
+            f.write("label_stem,bytes_written,encode_ms\n")
+            for label_stem, image_stats in sorted(stats.items()):
+                f.write(f"{label_stem},{image_stats.bytes_written},{1000 * image_stats.encode_seconds:.3f}\n")
+    if failures:
+        logger.error(f"{len(failures)} of {len(labels)} condition images failed")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+import json
+import logging
+import os
+import struct
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# JPEG start-of-frame markers (baseline, progressive, lossless, arithmetic); they carry the image size
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# Markers without a length field
+JPEG_STANDALONE_MARKERS = {0x01, *range(0xD0, 0xD9)}
+
+
+def _jpeg_size(f) -> tuple[int, int] | None:
+    f.seek(2)
+    while True:
+        byte = f.read(1)
+        if not byte:
+            return None
+        if byte != b"\xff":
+            continue
+        marker = f.read(1)
+        while marker == b"\xff":  # fill bytes
+            marker = f.read(1)
+        if not marker:
+            return None
+        marker = marker[0]
+        if marker in JPEG_STANDALONE_MARKERS:
+            continue
+        segment_length = f.read(2)
+        if len(segment_length) < 2:
+            return None
+        (segment_length,) = struct.unpack(">H", segment_length)
+        if marker in JPEG_SOF_MARKERS:
+            header = f.read(5)
+            if len(header) < 5:
+                return None
+            _precision, height, width = struct.unpack(">BHH", header)
+            return width, height
+        f.seek(segment_length - 2, os.SEEK_CUR)
+
+
+def probe_image_size(image_path: Path) -> tuple[int, int]:
+    """Return (width, height) of an image by reading only its header.
+
+    JPEG sizes come from the first SOF segment and PNG sizes from IHDR; both
+    match ``PIL.Image.open(path).size``. Other formats fall back to PIL,
+    which also only parses the header.
+
+    Args:
+        image_path: Path to the image.
+
+    Returns:
+        (width, height) in pixels.
+
+    Raises:
+        FileNotFoundError: If the image does not exist.
+    """
+    with open(image_path, "rb") as f:
+        head = f.read(24)
+        if head.startswith(PNG_SIGNATURE) and head[12:16] == b"IHDR":
+            return struct.unpack(">II", head[16:24])
+        if head.startswith(b"\xff\xd8"):
+            size = _jpeg_size(f)
+            if size is not None:
+                return size
+
+    from PIL import Image
+
+    with Image.open(image_path) as image:
+        return image.size
+
+
+class ImageSizeIndex:
+    """Persistent stem -> (width, height) index for one images directory.
+
+    Sizes are probed once with probe_image_size and kept in a single JSON
+    file (``.image_sizes.json`` in the images directory by default), so
+    later runs do not touch the images at all. Entries are not revalidated;
+    delete the index file after replacing images in place. An unreadable
+    index is ignored and rebuilt.
+
+    Concurrent processes may save different index files safely, but each
+    keeps only its own entries, so they should not share one index file.
+
+    Args:
+        images_dir: Directory with the images.
+        suffix: Image file suffix used to build paths from stems.
+        index_path: Where the index is stored, defaults to ``images_dir/.image_sizes.json``.
+    """
+
+    def __init__(self, images_dir: Path, suffix: str = ".jpg", index_path: Path | None = None):
+        self.images_dir = Path(images_dir)
+        self.suffix = suffix
+        self.index_path = Path(index_path) if index_path else self.images_dir / ".image_sizes.json"
+        self._sizes: dict[str, tuple[int, int]] = {}
+        self._dirty = False
+        if self.index_path.exists():
+            try:
+                with open(self.index_path, "r") as f:
+                    self._sizes = {stem: tuple(size) for stem, size in json.load(f).items()}
+            except (OSError, ValueError, TypeError, AttributeError) as e:
+                logger.warning(f"Ignoring unreadable image size index {self.index_path}: {e}")
+
+    def __contains__(self, stem: str) -> bool:
+        return stem in self._sizes
+
+    def __len__(self) -> int:
+        return len(self._sizes)
+
+    def cached(self, stem: str) -> tuple[int, int] | None:
+        """Return the indexed size of an image without probing it."""
+        return self._sizes.get(stem)
+
+    def get(self, stem: str) -> tuple[int, int]:
+        """Return the size of an image, probing and recording it if needed."""
+        size = self._sizes.get(stem)
+        if size is None:
+            size = probe_image_size(self.images_dir / f"{stem}{self.suffix}")
+            self.record(stem, size)
+        return size
+
+    def record(self, stem: str, size: tuple[int, int]) -> None:
+        """Add a size probed elsewhere (e.g. in a worker process)."""
+        if self._sizes.get(stem) != tuple(size):
+            self._sizes[stem] = tuple(size)
+            self._dirty = True
+
+    def save(self) -> None:
+        """Write the index if it changed; failures (e.g. read-only directory) are logged."""
+        if not self._dirty:
+            return
+        # Unique per process, so concurrent saves never write into the same file
+        tmp_path = self.index_path.with_name(f"{self.index_path.name}.{os.getpid()}.tmp")
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(self._sizes, f, separators=(",", ":"))
+            os.replace(tmp_path, self.index_path)
+            self._dirty = False
+        except OSError as e:
+            logger.warning(f"Could not write image size index {self.index_path}: {e}")
+            tmp_path.unlink(missing_ok=True)
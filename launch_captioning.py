@@ -0,0 +1,113 @@
+import argparse
+import logging
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+from metadata_io import shard_output_path, sort_jsonl
+
+logger = logging.getLogger(__name__)
+
+CAPTIONER = Path(__file__).with_name("create_metadata.py")
+
+
+def visible_gpus() -> list[str]:
+    """GPU ids from CUDA_VISIBLE_DEVICES, or from nvidia-smi if it is unset; empty without GPUs."""
+    if "CUDA_VISIBLE_DEVICES" in os.environ:
+        return [gpu for gpu in os.environ["CUDA_VISIBLE_DEVICES"].split(",") if gpu.strip()]
+    try:
+        result = subprocess.run(["nvidia-smi", "--query-gpu=index", "--format=csv,noheader"], capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return []
+    return [line.strip() for line in result.stdout.splitlines() if line.strip()]
+
+
+def launch_replicas(devices: list[str], image_dir: Path, output_file: Path, captioner_args: list[str]) -> list[int]:
+    """Run one captioner process per device, each on its own shard, and wait for all of them.
+
+    A GPU device is the only GPU visible to its replica; "cpu" runs a
+    replica without GPUs. Each replica logs to its shard output path with a
+    ``.log`` suffix.
+
+    Returns:
+        The exit code of every replica.
+    """
+    processes = []
+    for index, device in enumerate(devices):
+        env = dict(os.environ)
+        if device == "cpu":
+            env["CUDA_VISIBLE_DEVICES"] = ""
+            replica_device = "cpu"
+        else:
+            env["CUDA_VISIBLE_DEVICES"] = device
+            replica_device = "cuda:0"
+        command = [
+            sys.executable,
+            str(CAPTIONER),
+            "--image-dir",
+            str(image_dir),
+            "--output",
+            str(output_file),
+            "--shard",
+            f"{index}/{len(devices)}",
+            "--device",
+            replica_device,
+            *captioner_args,
+        ]
+        log_path = shard_output_path(output_file, index, len(devices)).with_suffix(".log")
+        log_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(log_path, "w") as log_file:
+            processes.append(subprocess.Popen(command, env=env, stdout=log_file, stderr=subprocess.STDOUT))
+        logger.info(f"Started replica {index} on {device} (pid {processes[-1].pid}), logging to {log_path}")
+
+    return_codes = []
+    for index, process in enumerate(processes):
+        return_codes.append(process.wait())
+        if return_codes[-1] != 0:
+            logger.error(f"Replica {index} on {devices[index]} failed with exit code {return_codes[-1]}")
+    return return_codes
+
+
+def merge_shard_outputs(shard_paths: list[Path], output_file: Path) -> int:
+    """Merge per-shard JSONL files into one, sorted by file_name like get_image_files.
+
+    Returns:
+        The number of merged entries.
+    """
+    return sort_jsonl(shard_paths, output_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Caption an image directory with one model replica per GPU and merge the results.",
+        epilog="Arguments after -- are passed to create_metadata.py, e.g. -- --resume --model-id PATH.",
+    )
+    parser.add_argument("--image-dir", type=Path, required=True)
+    parser.add_argument("--output", type=Path, required=True, help="Merged JSONL; shards are written next to it")
+    parser.add_argument("--devices", nargs="+", default=None, help='GPU ids or "cpu" per replica (default: all visible GPUs, else one CPU replica)')
+    parser.add_argument("--keep-shards", action="store_true", help="Keep the per-shard outputs after merging")
+    parser.add_argument("captioner_args", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+
+    captioner_args = args.captioner_args[1:] if args.captioner_args[:1] == ["--"] else args.captioner_args
+    devices = args.devices or visible_gpus() or ["cpu"]
+    logger.info(f"Captioning {args.image_dir} with {len(devices)} replicas on {', '.join(devices)}")
+
+    return_codes = launch_replicas(devices, args.image_dir, args.output, captioner_args)
+    if any(return_codes):
+        logger.error("Not merging because replicas failed; rerun with -- --resume to continue the shards")
+        raise SystemExit(1)
+
+    shard_paths = [shard_output_path(args.output, index, len(devices)) for index in range(len(devices))]
+    shard_paths = [path for path in shard_paths if path.exists()]
+    merged = merge_shard_outputs(shard_paths, args.output)
+    logger.info(f"Merged {merged} entries from {len(shard_paths)} shards into {args.output}")
+    if not args.keep_shards:
+        for path in shard_paths:
+            path.unlink()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,8 @@ from pathlib import Path
 import os
 import shutil
 
+from metadata_io import JsonlWriter, iter_jsonl
+
 
 keylabs_labels_eo = Path(
     "/Users/danielschmid/projects/PromptAdherence/markdown_generation/500_selected_images/anduril_eo_500_selected_demo_images/keylabs_labels"
@@ -81,45 +83,34 @@ def merge():
     merged_0 = process_keylabs_labels(keylabs_labels_eo, vqa_labels, is_eo=True)
     merged_1 = process_keylabs_labels(keylabs_labels_ir, merged_0, is_eo=False)
 
-    out_jsonl_eo = []
-    out_jsonl_ir = []
-    for img_name, label in merged_1.items():
-        label["img_name"] = img_name
-        is_eo = label["camera_type"] == "eo"
-        if is_eo:
-            out_jsonl_eo.append(label)
-        else:
-            out_jsonl_ir.append(label)
-    with open("merged_labels_eo.jsonl", "w") as f:
-        for label in out_jsonl_eo:
-            f.write(json.dumps(label) + "\n")
-    with open("merged_labels_ir.jsonl", "w") as f:
-        for label in out_jsonl_ir:
-            f.write(json.dumps(label) + "\n")
+    with JsonlWriter(Path("merged_labels_eo.jsonl")) as writer_eo, JsonlWriter(Path("merged_labels_ir.jsonl")) as writer_ir:
+        for img_name, label in merged_1.items():
+            label["img_name"] = img_name
+            is_eo = label["camera_type"] == "eo"
+            if is_eo:
+                writer_eo.write(label)
+            else:
+                writer_ir.write(label)
 
 def export_to_labels():
     vqa_labels = json.load(vqa_labels_path.open())
 
-    out_jsonl = [] 
-    for img_name, label in vqa_labels.items():
-        out_jsonl.append({
-            "img_name": img_name,
-            "uav_or_usv": label["uav_or_usv"],
-            "open_water_or_coastline": label["open_water_or_coastline"],
-            "ship_type": label["ship_type"],
-            "camera_type": "ir"
-        })
-
-    with open("merged_labels_ir_extra.jsonl", "w") as f:
-        for label in out_jsonl:
-            f.write(json.dumps(label) + "\n")
+    with JsonlWriter(Path("merged_labels_ir_extra.jsonl")) as writer:
+        for img_name, label in vqa_labels.items():
+            writer.write({
+                "img_name": img_name,
+                "uav_or_usv": label["uav_or_usv"],
+                "open_water_or_coastline": label["open_water_or_coastline"],
+                "ship_type": label["ship_type"],
+                "camera_type": "ir"
+            })
 
 def log_statistics_extra():
     ir_labels_path = Path("merged_labels_ir_extra.jsonl")
 
-    ir_labels = [json.loads(line) for line in ir_labels_path.open()]
+    ir_labels = iter_jsonl(ir_labels_path)
 
-    def _log_statistics(labels: list[dict]):
+    def _log_statistics(labels):
         counter = {}
 
         for label in labels:
@@ -143,10 +134,10 @@ def log_statistics():
     ir_labels_path = Path("merged_labels_ir.jsonl")
 
 
-    eo_labels = [json.loads(line) for line in eo_labels_path.open()]
-    ir_labels = [json.loads(line) for line in ir_labels_path.open()]
+    eo_labels = iter_jsonl(eo_labels_path)
+    ir_labels = iter_jsonl(ir_labels_path)
 
-    def _log_statistics(labels: list[dict]):
+    def _log_statistics(labels):
         counter = {}
 
         for label in labels:
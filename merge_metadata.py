@@ -1,28 +1,27 @@
 from pathlib import Path
-import json
-import shutil
+
+from metadata_io import JsonlWriter, iter_jsonl
 
 m_folder = Path("/Users/danielschmid/data_filtering/data/ir/checking-additional/") 
 prompt = None # "usv/open_water/water-vehicles-1-4" # "uav-open-water-background-no-objects" # None # "usv-open-water-background-birds-buoys-only" # "uav-open-water-background-no-objects" #None# "usv-open-water-1-4-water-vehicles"
 
-metadata_list = []
 
-for folder in m_folder.iterdir():
-    if folder.is_dir():
-        metadata_file = folder / "metadata.jsonl"
-        with open(metadata_file, "r") as f:
-            metadata = [json.loads(line) for line in f] 
-        
-        metadata_converted = []
-        for x in metadata:
+def iter_merged_metadata(folders):
+    for folder in folders:
+        for x in iter_jsonl(folder / "metadata.jsonl"):
             x['img_name'] = folder.name + "/" + x['img_name']
             if prompt:
                 x['prompt'] = prompt
-            metadata_converted.append(x)
-        
-        metadata_list.extend(metadata_converted)
+            yield x
+
+
+# List the folders before writing, so the merged file (and its partial file) are not picked up
+folders = []
+for folder in sorted(m_folder.iterdir()):
+    if folder.is_dir():
+        folders.append(folder)
     else:
         folder.unlink()
-with open(m_folder / "metadata.jsonl", "w") as f:
-    for x in metadata_list:
-        f.write(json.dumps(x) + "\n")
\ No newline at end of file
+
+with JsonlWriter(m_folder / "metadata.jsonl") as writer:
+    writer.write_many(iter_merged_metadata(folders))
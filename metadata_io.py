@@ -0,0 +1,234 @@
+import json
+import logging
+import mmap
+import os
+from collections.abc import Sequence
+from pathlib import Path
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+PARTIAL_SUFFIX = ".partial"
+
+
+def dumps_line(obj) -> bytes:
+    """Serialize one metadata entry to a compact, newline-terminated UTF-8 JSON line."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE)
+    return (json.dumps(obj, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+def loads_line(line: bytes | str):
+    """Parse one JSON line."""
+    if orjson is not None:
+        return orjson.loads(line)
+    return json.loads(line)
+
+
+def partial_path(path: Path) -> Path:
+    """Where JsonlWriter writes until the file is complete."""
+    path = Path(path)
+    return path.with_name(path.name + PARTIAL_SUFFIX)
+
+
+def shard_output_path(path: Path, index: int, count: int) -> Path:
+    """Output of shard ``index`` of ``count``, e.g. ``meta.shard-001-of-004.jsonl``."""
+    path = Path(path)
+    return path.with_name(f"{path.stem}.shard-{index:03d}-of-{count:03d}{path.suffix}")
+
+
+def repair_torn_tail(path: Path) -> int:
+    """Truncate a JSONL file after its last complete line, e.g. after a crash mid-write.
+
+    Returns:
+        The number of bytes removed.
+    """
+    with open(path, "r+b") as f:
+        size = f.seek(0, os.SEEK_END)
+        end, position = 0, size
+        while position > 0:
+            start = max(position - (1 << 16), 0)
+            f.seek(start)
+            newline = f.read(position - start).rfind(b"\n")
+            if newline >= 0:
+                end = start + newline + 1
+                break
+            position = start
+        if end < size:
+            f.truncate(end)
+    if end < size:
+        logger.warning(f"Removed a torn line ({size - end} bytes) from the end of {path}")
+    return size - end
+
+
+class JsonlWriter:
+    """Buffered, crash-safe JSONL writer.
+
+    By default entries go to ``{path}.partial``, which is flushed, fsynced and
+    atomically renamed to ``path`` when the writer is closed without an
+    error, so ``path`` only ever holds complete files. If the ``with`` block
+    raises, the partial file is kept for inspection and ``path`` is left
+    untouched.
+
+    With ``append=True`` entries are appended to ``path`` directly, after
+    cutting off a torn last line; use write_batch to make every batch durable.
+
+    Args:
+        path: Output JSONL file.
+        append: Append to an existing file instead of replacing it.
+        buffer_size: Write buffer size in bytes.
+    """
+
+    def __init__(self, path: Path, append: bool = False, buffer_size: int = 1 << 20):
+        self.path = Path(path)
+        self.append = append
+        self.count = 0
+        if append:
+            if self.path.exists():
+                repair_torn_tail(self.path)
+            self._target = self.path
+        else:
+            self._target = partial_path(self.path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self._target, "ab" if append else "wb", buffering=buffer_size)
+
+    def write(self, obj) -> None:
+        self._file.write(dumps_line(obj))
+        self.count += 1
+
+    def write_raw(self, line: bytes) -> None:
+        """Write an already serialized entry, e.g. a line copied from another JSONL file."""
+        self._file.write(line if line.endswith(b"\n") else line + b"\n")
+        self.count += 1
+
+    def write_many(self, objs) -> None:
+        for obj in objs:
+            self.write(obj)
+
+    def write_batch(self, objs) -> None:
+        """Write entries and make them durable before returning."""
+        self.write_many(objs)
+        self.sync()
+
+    def flush(self) -> None:
+        self._file.flush()
+
+    def sync(self) -> None:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self, complete: bool = True) -> None:
+        """Close the file; for a new file, publish it at ``path`` only if ``complete``."""
+        if self._file.closed:
+            return
+        self.sync()
+        self._file.close()
+        if complete and not self.append:
+            os.replace(self._target, self.path)
+        elif not complete:
+            logger.warning(f"Kept incomplete metadata with {self.count} entries at {self._target}")
+
+    def __enter__(self) -> "JsonlWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close(complete=exc_type is None)
+
+
+def iter_jsonl(path: Path):
+    """Lazily yield the entries of a JSONL file, skipping blank lines."""
+    with open(path, "rb") as f:
+        for line in f:
+            if line.strip():
+                yield loads_line(line)
+
+
+def write_jsonl(path: Path, objs) -> int:
+    """Stream entries to a JSONL file with JsonlWriter and return how many were written."""
+    with JsonlWriter(path) as writer:
+        writer.write_many(objs)
+    return writer.count
+
+
+def sort_jsonl(paths: list[Path], output_path: Path, key: str = "file_name") -> int:
+    """Write the entries of one or more JSONL files to one file, sorted by a field.
+
+    Inputs are memory-mapped and only (value, file, line) keys are held in
+    memory; lines are copied without re-serializing them. ``output_path``
+    may be one of the inputs, it is replaced atomically.
+
+    Returns:
+        The number of written entries.
+    """
+    files = [JsonlFile(path) for path in paths]
+    try:
+        keys = []
+        for file_index, jsonl_file in enumerate(files):
+            for line_index in range(len(jsonl_file)):
+                keys.append((loads_line(jsonl_file.line(line_index))[key], file_index, line_index))
+        keys.sort()
+        with JsonlWriter(output_path) as writer:
+            for _value, file_index, line_index in keys:
+                writer.write_raw(files[file_index].line(line_index))
+    finally:
+        for jsonl_file in files:
+            jsonl_file.close()
+    return len(keys)
+
+
+class JsonlFile(Sequence):
+    """Memory-mapped JSONL file with random access to its entries.
+
+    Only the line start offsets are kept in memory; entries are parsed on
+    access, so millions of lines can be indexed, sliced or iterated without
+    loading the file.
+
+    Args:
+        path: JSONL file; blank lines are not skipped and parse as errors.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._file = open(self.path, "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        if size == 0:
+            self._mmap = b""
+            self.offsets = np.zeros(1, dtype=np.int64)
+            return
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        newlines = np.flatnonzero(np.frombuffer(self._mmap, dtype=np.uint8) == ord("\n"))
+        ends = newlines + 1 if newlines.size and newlines[-1] == size - 1 else np.append(newlines + 1, size)
+        self.offsets = np.concatenate([[0], ends]).astype(np.int64)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def line(self, index: int) -> bytes:
+        """Raw bytes of one line, without parsing it."""
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self._mmap[self.offsets[index]:self.offsets[index + 1]]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return loads_line(self.line(index))
+
+    def close(self) -> None:
+        if isinstance(self._mmap, mmap.mmap):
+            self._mmap.close()
+        self._file.close()
+
+    def __enter__(self) -> "JsonlFile":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
@@ -0,0 +1,85 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+pytest.importorskip("qwen_vl_utils")
+
+import create_metadata
+from metadata_io import iter_jsonl, partial_path
+
+# A small Qwen2.5-VL checkpoint (local path or hub id) for the CPU smoke test
+TEST_MODEL = os.environ.get("CAPTION_TEST_MODEL")
+
+
+def test_select_shard_partitions_images():
+    image_files = [Path(f"{i:05d}.png") for i in range(500)]
+    shards = [create_metadata.select_shard(image_files, index, 4) for index in range(4)]
+    assert sorted(path for shard in shards for path in shard) == image_files
+    assert all(shards)
+    # Assignment depends only on the file name, not on the other images
+    assert create_metadata.select_shard(image_files[:100], 1, 4) == [path for path in shards[1] if path in image_files[:100]]
+
+
+def test_completed_file_names_adopts_partial_and_repairs_tail(tmp_path):
+    output = tmp_path / "meta.jsonl"
+    partial_path(output).write_bytes(b'{"file_name":"a.png","caption":"x"}\n{"file_name":"b.png","capt')
+
+    assert create_metadata.completed_file_names(output) == {"a.png"}
+    assert not partial_path(output).exists()
+    assert output.read_bytes() == b'{"file_name":"a.png","caption":"x"}\n'
+    assert create_metadata.completed_file_names(tmp_path / "missing.jsonl") == set()
+
+
+def test_token_budget_batcher_splits_stale_batches_without_shrinking():
+    image_files = [Path(f"{i}.png") for i in range(256)]
+    batcher = create_metadata.TokenBudgetBatcher(image_files, [512] * len(image_files), token_budget=32768, max_batch_size=64)
+    prefetched = [batch for batch, _ in zip(batcher, range(4))]
+
+    assert batcher.shrink(prefetched[0])
+    assert batcher.token_budget == 16384
+    for batch in prefetched[1:]:
+        assert not batcher.shrink(batch)
+        assert [len(sub_batch) for sub_batch in batcher.split(batch)] == [32, 32]
+    assert batcher.token_budget == 16384
+
+
+@pytest.mark.skipif(TEST_MODEL is None, reason="set CAPTION_TEST_MODEL to a small Qwen2.5-VL checkpoint")
+def test_launcher_smoke_on_cpu(tmp_path):
+    from PIL import Image
+
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    for i in range(6):
+        Image.new("RGB", (56 + 28 * i, 56), color=(40 * i, 80, 120)).save(image_dir / f"{i:02d}.png")
+    output = tmp_path / "meta.jsonl"
+
+    command = [
+        sys.executable,
+        str(Path(__file__).with_name("launch_captioning.py")),
+        "--image-dir",
+        str(image_dir),
+        "--output",
+        str(output),
+        "--devices",
+        "cpu",
+        "cpu",
+        "--",
+        "--model-id",
+        TEST_MODEL,
+        "--no-cache",
+        "--max-batch-size",
+        "2",
+        "--preprocess-workers",
+        "1",
+    ]
+    subprocess.run(command, check=True, timeout=1800)
+
+    entries = list(iter_jsonl(output))
+    assert [entry["file_name"] for entry in entries] == [f"{i:02d}.png" for i in range(6)]
+    assert all(isinstance(entry["caption"], str) for entry in entries)
+    assert [entry["condition"] for entry in entries] == [f"{i:02d}_condition.png" for i in range(6)]
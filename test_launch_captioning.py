@@ -0,0 +1,147 @@
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+import caption_cache
+import launch_captioning
+from caption_cache import CaptionCache
+from metadata_io import JsonlWriter, iter_jsonl, partial_path, shard_output_path
+
+# Stands in for create_metadata.py: writes its shard (selected like select_shard) in reverse order
+FAKE_CAPTIONER = """
+import argparse, json, os, sys, zlib
+from pathlib import Path
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--image-dir", type=Path)
+parser.add_argument("--output", type=Path)
+parser.add_argument("--shard")
+parser.add_argument("--device")
+args, extra = parser.parse_known_args()
+if "--fail" in extra:
+    sys.exit(3)
+index, count = (int(part) for part in args.shard.split("/"))
+names = sorted(path.name for path in args.image_dir.iterdir() if zlib.crc32(path.name.encode()) % count == index)
+shard = args.output.with_name(f"{args.output.stem}.shard-{index:03d}-of-{count:03d}{args.output.suffix}")
+with open(shard, "w") as f:
+    for name in reversed(names):
+        entry = {"file_name": name, "caption": "ünïcode", "device": args.device, "visible": os.environ["CUDA_VISIBLE_DEVICES"], "extra": extra}
+        f.write(json.dumps(entry) + "\\n")
+"""
+
+
+def test_shard_output_path():
+    assert shard_output_path(Path("/data/meta.jsonl"), 1, 4) == Path("/data/meta.shard-001-of-004.jsonl")
+    assert shard_output_path(Path("/data/.sizes.json"), 0, 2) == Path("/data/.sizes.shard-000-of-002.json")
+
+
+def test_jsonl_writer_publishes_only_complete_files(tmp_path):
+    path = tmp_path / "meta.jsonl"
+    with pytest.raises(RuntimeError):
+        with JsonlWriter(path) as writer:
+            writer.write({"file_name": "a.png"})
+            raise RuntimeError("interrupted")
+    assert not path.exists()
+    assert list(iter_jsonl(partial_path(path))) == [{"file_name": "a.png"}]
+
+    with JsonlWriter(path) as writer:
+        writer.write_many([{"file_name": "a.png"}, {"file_name": "b.png"}])
+    assert [entry["file_name"] for entry in iter_jsonl(path)] == ["a.png", "b.png"]
+    assert not partial_path(path).exists()
+
+
+def test_jsonl_writer_append_repairs_torn_tail(tmp_path):
+    path = tmp_path / "meta.jsonl"
+    path.write_bytes(b'{"file_name":"a.png"}\n{"file_na')
+    with JsonlWriter(path, append=True) as writer:
+        writer.write_batch([{"file_name": "b.png"}])
+    assert [entry["file_name"] for entry in iter_jsonl(path)] == ["a.png", "b.png"]
+
+
+def test_merge_shard_outputs_sorts_by_file_name(tmp_path):
+    shard_paths = [tmp_path / "meta.shard-000-of-002.jsonl", tmp_path / "meta.shard-001-of-002.jsonl"]
+    shard_paths[0].write_text('{"file_name": "c.png", "caption": "ü"}\n{"file_name":"a.png","caption":"x"}\n', encoding="utf-8")
+    # Last line without a newline, as left by a replica that was killed after its last flush
+    shard_paths[1].write_text('{"file_name":"b.png","caption":"y"}', encoding="utf-8")
+
+    output = tmp_path / "meta.jsonl"
+    assert launch_captioning.merge_shard_outputs(shard_paths, output) == 3
+    # Lines are copied as they are, not re-serialized
+    assert output.read_text(encoding="utf-8").splitlines() == [
+        '{"file_name":"a.png","caption":"x"}',
+        '{"file_name":"b.png","caption":"y"}',
+        '{"file_name": "c.png", "caption": "ü"}',
+    ]
+
+
+def test_caption_cache_evicts_least_recently_used(tmp_path, monkeypatch):
+    clock = iter(range(1000))
+    monkeypatch.setattr(caption_cache.time, "time", lambda: next(clock))
+    # Each entry is 1 key byte plus 99 caption bytes
+    cache = CaptionCache(tmp_path / "captions.sqlite", max_bytes=250)
+    cache.put_many({"a": "x" * 99})
+    cache.put_many({"b": "x" * 99})
+    assert cache.get_many(["a", "missing"]) == {"a": "x" * 99}
+
+    cache.put_many({"c": "x" * 99})
+    assert len(cache) == 2
+    assert cache.get_many(["a", "b", "c"]).keys() == {"a", "c"}
+    assert (cache.hits, cache.misses) == (3, 2)
+    assert cache.size_bytes() == 200
+    cache.close()
+
+    reopened = CaptionCache(tmp_path / "captions.sqlite")
+    assert reopened.get("c") == "x" * 99
+    reopened.close()
+
+
+def test_cache_key_depends_on_every_setting():
+    key = CaptionCache.make_key("hash", "model", "prompt", {"max_new_tokens": 64})
+    assert key == CaptionCache.make_key("hash", "model", "prompt", {"max_new_tokens": 64})
+    assert key != CaptionCache.make_key("other", "model", "prompt", {"max_new_tokens": 64})
+    assert key != CaptionCache.make_key("hash", "other", "prompt", {"max_new_tokens": 64})
+    assert key != CaptionCache.make_key("hash", "model", "other", {"max_new_tokens": 64})
+    assert key != CaptionCache.make_key("hash", "model", "prompt", {"max_new_tokens": 32})
+
+
+@pytest.fixture
+def fake_launch(tmp_path, monkeypatch):
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    for i in range(20):
+        (image_dir / f"{i:03d}.png").write_bytes(b"")
+    captioner = tmp_path / "fake_captioner.py"
+    captioner.write_text(FAKE_CAPTIONER)
+    monkeypatch.setattr(launch_captioning, "CAPTIONER", captioner)
+
+    def launch(*args):
+        monkeypatch.setattr(sys, "argv", ["launch_captioning.py", "--image-dir", str(image_dir), "--output", str(tmp_path / "meta.jsonl"), *args])
+        launch_captioning.main()
+
+    return launch
+
+
+def test_launcher_runs_one_replica_per_device_and_merges(tmp_path, fake_launch):
+    fake_launch("--devices", "cpu", "cpu", "cpu", "--", "--resume")
+
+    entries = list(iter_jsonl(tmp_path / "meta.jsonl"))
+    assert [entry["file_name"] for entry in entries] == [f"{i:03d}.png" for i in range(20)]
+    assert all(entry["device"] == "cpu" and entry["visible"] == "" and entry["extra"] == ["--resume"] for entry in entries)
+    assert not list(tmp_path.glob("meta.shard-*.jsonl"))
+    assert len(list(tmp_path.glob("meta.shard-*.log"))) == 3
+
+
+def test_launcher_does_not_merge_after_failed_replica(tmp_path, fake_launch):
+    with pytest.raises(SystemExit):
+        fake_launch("--devices", "cpu", "cpu", "--", "--fail")
+    assert not (tmp_path / "meta.jsonl").exists()
+
+
+def test_launcher_gives_each_gpu_replica_one_visible_device(tmp_path, fake_launch):
+    fake_launch("--devices", "2", "5", "--keep-shards")
+
+    shards = [json.loads(line) for path in sorted(tmp_path.glob("meta.shard-*.jsonl")) for line in path.read_text().splitlines()]
+    assert {(entry["visible"], entry["device"]) for entry in shards} == {("2", "cuda:0"), ("5", "cuda:0")}
+    assert len(list(iter_jsonl(tmp_path / "meta.jsonl"))) == 20
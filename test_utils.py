@@ -0,0 +1,102 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import utils
+
+LABELS = ['/m/car', '/m/boat', '/m/bird']
+
+
+def write_annotations(csv_path, n_images=40, seed=0):
+    """Write a small annotation CSV sorted by ImageID with 1-6 boxes per image."""
+    rng = np.random.default_rng(seed)
+    counts = rng.integers(1, 7, n_images)
+    n_boxes = counts.sum()
+    width = rng.uniform(0.05, 0.4, n_boxes)
+    height = rng.uniform(0.05, 0.4, n_boxes)
+    xmin = rng.uniform(0, 1 - width)
+    ymin = rng.uniform(0, 1 - height)
+    annotations = pd.DataFrame({
+        'ImageID': np.repeat([f'{i:08x}' for i in range(n_images)], counts),
+        'Source': 'xclick',
+        'LabelName': rng.choice(LABELS, n_boxes),
+        'Confidence': 1,
+        'XMin': xmin, 'XMax': xmin + width, 'YMin': ymin, 'YMax': ymin + height,
+        'IsOccluded': (rng.random(n_boxes) < 0.2).astype(int),
+        'IsTruncated': (rng.random(n_boxes) < 0.2).astype(int),
+        'IsGroupOf': 0,
+        'IsDepiction': 0,
+        'IsInside': 0,
+    })
+    annotations.to_csv(csv_path, index=False, float_format='%.6f')
+    return annotations
+
+
+def read_label_files(output_dir):
+    return {path.name: path.read_text() for path in sorted(output_dir.iterdir())}
+
+
+@pytest.fixture(autouse=True)
+def clear_tables():
+    utils.clear_annotation_tables()
+    utils.clear_label_hierarchies()
+    yield
+    utils.clear_annotation_tables()
+    utils.clear_label_hierarchies()
+
+
+def test_filter_csv_to_yolo_modes_write_identical_files(tmp_path):
+    csv_path = tmp_path / 'annotations.csv'
+    write_annotations(csv_path)
+    label_to_class_id = utils.create_label_to_class_id_mapping(LABELS[:2])
+    filters = {
+        'allowed_labels': LABELS[:2],
+        'attributes': {'is_occluded': None, 'is_truncated': 0},
+        'overlap': {'keep_overlapping': False},
+    }
+
+    written = {
+        'memory': utils.filter_csv_to_yolo(csv_path, tmp_path / 'memory', label_to_class_id, **filters),
+        # 7 rows per chunk, so most chunks end in the middle of an image
+        'streaming': utils.filter_csv_to_yolo(csv_path, tmp_path / 'streaming', label_to_class_id, chunksize=7, **filters),
+        'parallel': utils.filter_csv_to_yolo(csv_path, tmp_path / 'parallel', label_to_class_id, num_workers=2, **filters),
+        'streaming-parallel': utils.filter_csv_to_yolo(
+            csv_path, tmp_path / 'streaming-parallel', label_to_class_id, chunksize=7, num_workers=2, **filters
+        ),
+    }
+
+    expected = read_label_files(tmp_path / 'memory')
+    assert 0 < len(expected) < 40
+    for mode, count in written.items():
+        assert count == len(expected), mode
+        assert read_label_files(tmp_path / mode) == expected, mode
+
+
+def test_iter_image_chunks_never_splits_images(tmp_path):
+    csv_path = tmp_path / 'annotations.csv'
+    annotations = write_annotations(csv_path)
+
+    chunks = list(utils.iter_image_chunks(csv_path, chunksize=7))
+    assert sum(len(chunk) for chunk in chunks) == len(annotations)
+    image_ids = [set(chunk['ImageID']) for chunk in chunks]
+    for previous, current in zip(image_ids, image_ids[1:]):
+        assert not previous & current
+
+
+def test_streaming_rejects_unsorted_csv(tmp_path):
+    csv_path = tmp_path / 'annotations.csv'
+    annotations = write_annotations(csv_path)
+    annotations.iloc[::-1].to_csv(csv_path, index=False, float_format='%.6f')
+
+    with pytest.raises(ValueError, match='sorted'):
+        utils.filter_csv_to_yolo(csv_path, tmp_path / 'out', {label: 0 for label in LABELS}, chunksize=7)
+
+
+def test_load_label_hierarchy_picks_up_edited_file(tmp_path):
+    hierarchy_path = tmp_path / 'hierarchy.json'
+    hierarchy_path.write_text('{"LabelName": "/m/root", "Subcategory": [{"LabelName": "/m/car"}]}')
+    assert utils.load_label_hierarchy(hierarchy_path).descendants('/m/root') == ['/m/root', '/m/car']
+    assert utils.load_label_hierarchy(hierarchy_path) is utils.load_label_hierarchy(hierarchy_path)
+
+    hierarchy_path.write_text('{"LabelName": "/m/root", "Subcategory": [{"LabelName": "/m/car"}, {"LabelName": "/m/boat"}]}')
+    assert utils.load_label_hierarchy(hierarchy_path).descendants('/m/root') == ['/m/root', '/m/car', '/m/boat']
@@ -1,47 +1,322 @@
+from collections import deque
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import json
+import logging
+from multiprocessing import shared_memory
+import os
 from pathlib import Path
+import numpy as np
 import pandas as pd
 
-def get_unique_values(csv_path, column_name):
+logger = logging.getLogger(__name__)
+
+# Compact dtypes for the Open Images annotation CSVs. Columns that are not
+# present in a given file are ignored, everything else is left to pandas.
+ANNOTATION_DTYPES = {
+    'ImageID': 'category',
+    'Source': 'category',
+    'LabelName': 'category',
+    'Confidence': 'int8',
+    'XMin': 'float32',
+    'XMax': 'float32',
+    'YMin': 'float32',
+    'YMax': 'float32',
+    'IsOccluded': 'int8',
+    'IsTruncated': 'int8',
+    'IsGroupOf': 'int8',
+    'IsDepiction': 'int8',
+    'IsInside': 'int8',
+    **{f'XClick{i}{axis}': 'float32' for i in range(1, 5) for axis in 'XY'},
+}
+
+class AnnotationTable:
     """
-    Get all unique values from a specific column in a CSV file.
+    In-memory, columnar copy of an Open Images style annotation CSV.
+    
+    The CSV is parsed once with the compact dtypes from ``ANNOTATION_DTYPES``
+    (categorical IDs, float32 boxes, int8 flags). The parsed table is stored
+    as a Parquet sidecar next to the CSV, keyed on the CSV's size and mtime,
+    so later sessions skip the CSV parser entirely.
+    
+    Parameters:
+    -----------
+    df : pd.DataFrame
+        The parsed annotation table
+    source_path : Path, optional
+        The CSV the table was loaded from
+    """
+    
+    def __init__(self, df, source_path=None):
+        self.df = df
+        self.source_path = source_path
+    
+    @staticmethod
+    def sidecar_path(csv_path, stat=None):
+        """Return the Parquet sidecar path for the current version of csv_path."""
+        csv_path = Path(csv_path)
+        stat = stat or csv_path.stat()
+        return csv_path.with_name(f".{csv_path.name}.{stat.st_size}-{stat.st_mtime_ns}.parquet")
+    
+    @classmethod
+    def from_csv(cls, csv_path, use_cache=True):
+        """
+        Load a CSV, going through the Parquet sidecar when it is up to date.
+        
+        Parameters:
+        -----------
+        csv_path : str or Path
+            Path to the CSV file
+        use_cache : bool, default=True
+            Read and write the Parquet sidecar. Caching is skipped silently
+            when pyarrow is missing or the directory is not writable.
+        
+        Returns:
+        --------
+        AnnotationTable
+        """
+        csv_path = Path(csv_path)
+        sidecar = cls.sidecar_path(csv_path)
+        
+        if use_cache and sidecar.exists():
+            try:
+                return cls(pd.read_parquet(sidecar), csv_path)
+            except (ImportError, OSError, ValueError) as e:
+                logger.warning(f"Ignoring unreadable cache {sidecar}: {e}")
+        
+        header = pd.read_csv(csv_path, nrows=0).columns
+        dtypes = {col: dtype for col, dtype in ANNOTATION_DTYPES.items() if col in header}
+        df = pd.read_csv(csv_path, dtype=dtypes)
+        
+        if use_cache:
+            cls._write_sidecar(df, csv_path, sidecar)
+        return cls(df, csv_path)
+    
+    @staticmethod
+    def _write_sidecar(df, csv_path, sidecar):
+        tmp_path = sidecar.with_name(sidecar.name + '.tmp')
+        try:
+            df.to_parquet(tmp_path, index=False)
+            tmp_path.replace(sidecar)
+        except (ImportError, OSError) as e:
+            logger.warning(f"Could not write cache {sidecar}: {e}")
+            tmp_path.unlink(missing_ok=True)
+            return
+        
+        # Drop sidecars left behind by older versions of the CSV
+        for stale in csv_path.parent.glob(f".{csv_path.name}.*.parquet"):
+            if stale != sidecar:
+                stale.unlink(missing_ok=True)
+
+_ANNOTATION_TABLES = {}
+
+def load_annotation_table(csv_path, use_cache=True):
+    """
+    Get the shared AnnotationTable for a CSV file.
+    
+    Tables are memoized per (path, size, mtime), so every helper in this
+    module that is called with the same CSV reuses one in-memory table.
     
     Parameters:
     -----------
     csv_path : str or Path
         Path to the CSV file
-    column_name : str
-        Name of the column to get unique values from
+    use_cache : bool, default=True
+        Use the on-disk Parquet sidecar (see AnnotationTable.from_csv)
     
     Returns:
     --------
-    numpy.ndarray or pandas.Index
-        Array of unique values from the specified column
+    AnnotationTable
     """
-    df = pd.read_csv(csv_path)
-    return df[column_name].unique()
+    csv_path = Path(csv_path).resolve()
+    stat = csv_path.stat()
+    key = (csv_path, stat.st_size, stat.st_mtime_ns)
+    
+    table = _ANNOTATION_TABLES.get(key)
+    if table is None:
+        # Only keep the latest version of each file in memory
+        for old_key in [k for k in _ANNOTATION_TABLES if k[0] == csv_path]:
+            del _ANNOTATION_TABLES[old_key]
+        table = AnnotationTable.from_csv(csv_path, use_cache=use_cache)
+        _ANNOTATION_TABLES[key] = table
+    return table
 
-def get_dataframes_by_image_id(csv_path, image_id_column='ImageID'):
+def clear_annotation_tables():
+    """Release all memoized annotation tables."""
+    _ANNOTATION_TABLES.clear()
+
+class ImageIndex(Mapping):
     """
-    Get a dictionary mapping image IDs to their corresponding DataFrames.
+    Read-only ``dict[str, pd.DataFrame]`` view over annotations grouped by image.
+    
+    All rows live in one DataFrame in which the rows of each image are
+    contiguous. ``offsets[i]:offsets[i + 1]`` is the row range of
+    ``image_ids[i]``, and the per-image DataFrame is only sliced out when it
+    is accessed. It can be passed anywhere a dict of per-image DataFrames
+    is accepted.
+    
+    Parameters:
+    -----------
+    df : pd.DataFrame
+        Annotation rows, grouped contiguously by image
+    image_ids : array-like
+        Unique image IDs, one per group, in row order
+    offsets : array-like of int
+        Group boundaries into df, of length len(image_ids) + 1
+    """
+    
+    def __init__(self, df, image_ids, offsets):
+        self.df = df
+        self.image_ids = pd.Index(image_ids)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+    
+    @classmethod
+    def from_dataframe(cls, df, image_id_column='ImageID'):
+        """
+        Build an index from an annotation DataFrame.
+        
+        Images are ordered by ID and rows keep their original order within
+        each image, matching ``df.groupby(image_id_column)``. Tables that are
+        already sorted by image ID (like the Open Images CSVs) are not copied.
+        
+        Parameters:
+        -----------
+        df : pd.DataFrame
+            Annotation table
+        image_id_column : str, default='ImageID'
+            Name of the column containing image IDs
+        
+        Returns:
+        --------
+        ImageIndex
+        """
+        ids = df[image_id_column]
+        if isinstance(ids.dtype, pd.CategoricalDtype):
+            ids = ids.cat.remove_unused_categories()
+            codes = ids.cat.codes.to_numpy()
+            image_ids = ids.cat.categories
+            if not image_ids.is_monotonic_increasing:
+                order = image_ids.argsort()
+                rank = np.empty_like(order)
+                rank[order] = np.arange(len(order))
+                codes = rank[codes]
+                image_ids = image_ids[order]
+        else:
+            codes, image_ids = pd.factorize(ids, sort=True)
+        
+        # Rows without an image ID are dropped, as groupby does
+        if (codes < 0).any():
+            df = df[codes >= 0]
+            codes = codes[codes >= 0]
+        if (np.diff(codes) < 0).any():
+            order = np.argsort(codes, kind='stable')
+            df = df.iloc[order]
+            codes = codes[order]
+        
+        return cls(df, image_ids, cls._offsets_from_counts(np.bincount(codes, minlength=len(image_ids))))
+    
+    @classmethod
+    def from_mapping(cls, image_to_labels):
+        """
+        Build an index from a dict of per-image DataFrames.
+        
+        ImageIndex instances are returned unchanged. Images with no rows are
+        dropped.
+        
+        Parameters:
+        -----------
+        image_to_labels : dict[str, pd.DataFrame]
+            Dictionary mapping image IDs to DataFrames containing labels
+        
+        Returns:
+        --------
+        ImageIndex
+        """
+        if isinstance(image_to_labels, ImageIndex):
+            return image_to_labels
+        
+        items = [(image_id, df) for image_id, df in image_to_labels.items() if len(df) > 0]
+        if not items:
+            return cls(pd.DataFrame(), [], [0])
+        image_ids, frames = zip(*items)
+        counts = np.fromiter((len(df) for df in frames), dtype=np.int64, count=len(frames))
+        return cls(pd.concat(frames), list(image_ids), cls._offsets_from_counts(counts))
+    
+    @staticmethod
+    def _offsets_from_counts(counts):
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return offsets
+    
+    @property
+    def counts(self):
+        """Number of rows per image, aligned with image_ids."""
+        return np.diff(self.offsets)
+    
+    def row_image_positions(self):
+        """Position in image_ids of the image each row belongs to."""
+        return np.repeat(np.arange(len(self.image_ids)), self.counts)
+    
+    def take_rows(self, row_mask):
+        """
+        Keep only the rows where row_mask is True.
+        
+        Images left without rows are dropped. Returns self when every row is
+        kept.
+        
+        Parameters:
+        -----------
+        row_mask : numpy.ndarray of bool
+            One entry per row of df
+        
+        Returns:
+        --------
+        ImageIndex
+        """
+        if row_mask.all():
+            return self
+        counts = np.add.reduceat(row_mask, self.offsets[:-1]) if len(self) else self.counts
+        keep = counts > 0
+        return ImageIndex(self.df[row_mask], self.image_ids[keep], self._offsets_from_counts(counts[keep]))
+    
+    def __getitem__(self, image_id):
+        pos = self.image_ids.get_loc(image_id)
+        return self.df.iloc[self.offsets[pos]:self.offsets[pos + 1]]
+    
+    def __iter__(self):
+        return iter(self.image_ids)
+    
+    def __len__(self):
+        return len(self.image_ids)
+    
+    def __contains__(self, image_id):
+        return image_id in self.image_ids
+    
+    def __repr__(self):
+        return f"ImageIndex({len(self)} images, {self.offsets[-1]} rows)"
+
+def get_unique_values(csv_path, column_name):
+    """
+    Get all unique values from a specific column in a CSV file.
     
     Parameters:
     -----------
     csv_path : str or Path
         Path to the CSV file
-    image_id_column : str, default='ImageID'
-        Name of the column containing image IDs
+    column_name : str
+        Name of the column to get unique values from
     
     Returns:
     --------
-    dict[str, pd.DataFrame]
-        Dictionary where keys are image IDs (strings) and values are DataFrames
-        containing all rows for that image ID
+    numpy.ndarray
+        Array of unique values from the specified column
     """
-    df = pd.read_csv(csv_path)
-    return {image_id: group_df for image_id, group_df in df.groupby(image_id_column)}
-def get_entry_count_distribution(csv_path, image_id_column='ImageID'):
+    df = load_annotation_table(csv_path).df
+    return np.asarray(df[column_name].unique())
+
+def get_dataframes_by_image_id(csv_path, image_id_column='ImageID'):
     """
-    Get a dictionary mapping the number of entries per image to the occurrence count.
+    Get a dictionary mapping image IDs to their corresponding DataFrames.
     
     Parameters:
     -----------
@@ -52,13 +327,13 @@ def get_entry_count_distribution(csv_path, image_id_column='ImageID'):
     
     Returns:
     --------
-    dict[int, int]
-        Dictionary where keys are the number of entries (rows) for an image,
-        and values are the occurrence count (how many images have that many entries)
+    ImageIndex
+        Mapping where keys are image IDs (strings) and values are DataFrames
+        containing all rows for that image ID. DataFrames are sliced out of
+        the shared table lazily, on access.
     """
-    df = pd.read_csv(csv_path)
-    entry_counts = df.groupby(image_id_column).size()
-    return dict(entry_counts.value_counts().sort_index())
+    df = load_annotation_table(csv_path).df
+    return ImageIndex.from_dataframe(df, image_id_column)
 
 def get_entry_count_distribution(csv_path, image_id_column='ImageID'):
     """
@@ -77,8 +352,8 @@ def get_entry_count_distribution(csv_path, image_id_column='ImageID'):
         Dictionary where keys are the number of entries (rows) for an image,
         and values are the occurrence count (how many images have that many entries)
     """
-    df = pd.read_csv(csv_path)
-    entry_counts = df.groupby(image_id_column).size()
+    df = load_annotation_table(csv_path).df
+    entry_counts = df.groupby(image_id_column, observed=True).size()
     return dict(entry_counts.value_counts().sort_index())
 
 def load_class_descriptions(csv_path):
@@ -95,10 +370,173 @@ def load_class_descriptions(csv_path):
     dict[str, str]
         Dictionary mapping LabelName to DisplayName
     """
-    df = pd.read_csv(csv_path)
+    df = load_annotation_table(csv_path).df
     return dict(zip(df['LabelName'], df['DisplayName']))
 
-import json
+class LabelHierarchy:
+    """
+    Precomputed index over the Open Images label hierarchy JSON.
+    
+    The tree is walked once, iteratively, and every label is written out in
+    pre-order. Each occurrence of a label gets the [start, stop) interval of
+    its subtree in that order (Euler tour), so "all labels under X" is a
+    slice and "is A under B" is an interval check. Labels that appear at
+    several places in the tree keep every occurrence; lookups by label use
+    the first occurrence in pre-order, like the original recursive search.
+    
+    Parameters:
+    -----------
+    hierarchy : dict or list
+        Parsed hierarchy JSON
+    class_descriptions : dict[str, str], optional
+        Mapping from LabelName to DisplayName
+    """
+    
+    def __init__(self, hierarchy, class_descriptions=None):
+        self._order = []
+        self._intervals = {}
+        self._build(hierarchy)
+        
+        self._display_names = dict(class_descriptions or {})
+        self._labels_by_display_name = {}
+        for label_name, display_name in self._display_names.items():
+            self._labels_by_display_name.setdefault(display_name, label_name)
+    
+    @classmethod
+    def from_files(cls, hierarchy_path, class_descriptions_path=None):
+        """
+        Load a hierarchy JSON and, optionally, a class descriptions CSV.
+        
+        Parameters:
+        -----------
+        hierarchy_path : str or Path
+            Path to the hierarchy JSON file
+        class_descriptions_path : str or Path, optional
+            Path to the class descriptions CSV file
+        
+        Returns:
+        --------
+        LabelHierarchy
+        """
+        with open(hierarchy_path, 'r') as f:
+            hierarchy = json.load(f)
+        class_descriptions = load_class_descriptions(class_descriptions_path) if class_descriptions_path else None
+        return cls(hierarchy, class_descriptions)
+    
+    def _build(self, hierarchy):
+        # Plain tuples on the stack mark the end of a label's subtree
+        stack = [hierarchy] if isinstance(hierarchy, dict) else list(reversed(hierarchy))
+        while stack:
+            node = stack.pop()
+            if isinstance(node, tuple):
+                label_name, start = node
+                self._intervals.setdefault(label_name, []).append((start, len(self._order)))
+                continue
+            if not isinstance(node, dict):
+                continue
+            if 'LabelName' in node:
+                stack.append((node['LabelName'], len(self._order)))
+                self._order.append(node['LabelName'])
+            stack.extend(reversed(node.get('Subcategory', [])))
+        
+        for intervals in self._intervals.values():
+            intervals.sort()
+    
+    def __contains__(self, label_name):
+        return label_name in self._intervals
+    
+    def descendants(self, label_name):
+        """
+        Get label_name followed by every label below it, in pre-order.
+        
+        Parameters:
+        -----------
+        label_name : str
+            The LabelName to look up
+        
+        Returns:
+        --------
+        list[str]
+            Labels of the subtree, or an empty list for unknown labels
+        """
+        intervals = self._intervals.get(label_name)
+        if not intervals:
+            return []
+        start, stop = intervals[0]
+        return self._order[start:stop]
+    
+    def is_under(self, label_name, ancestor_label_name):
+        """
+        Check whether label_name is ancestor_label_name or anywhere below it.
+        
+        Parameters:
+        -----------
+        label_name : str
+            The LabelName to check
+        ancestor_label_name : str
+            The LabelName of the candidate ancestor
+        
+        Returns:
+        --------
+        bool
+        """
+        ancestor_intervals = self._intervals.get(ancestor_label_name, [])
+        return any(
+            start <= position < stop
+            for position, _ in self._intervals.get(label_name, [])
+            for start, stop in ancestor_intervals
+        )
+    
+    def display_name(self, label_name):
+        """Get the DisplayName of a label, or None if it is unknown."""
+        return self._display_names.get(label_name)
+    
+    def label_for(self, display_name):
+        """Get the first LabelName with the given DisplayName, or None."""
+        return self._labels_by_display_name.get(display_name)
+
+_LABEL_HIERARCHIES = {}
+
+def _file_version(path):
+    path = Path(path).resolve()
+    stat = path.stat()
+    return (path, stat.st_size, stat.st_mtime_ns)
+
+def load_label_hierarchy(hierarchy_path, class_descriptions_path=None):
+    """
+    Get the shared LabelHierarchy for a hierarchy JSON (and class descriptions CSV).
+    
+    Hierarchies are memoized per (path, size, mtime) of both files, like
+    load_annotation_table, so edited files are picked up.
+    
+    Parameters:
+    -----------
+    hierarchy_path : str or Path
+        Path to the hierarchy JSON file
+    class_descriptions_path : str or Path, optional
+        Path to the class descriptions CSV file
+    
+    Returns:
+    --------
+    LabelHierarchy
+    """
+    hierarchy_version = _file_version(hierarchy_path)
+    descriptions_version = _file_version(class_descriptions_path) if class_descriptions_path else None
+    key = (hierarchy_version, descriptions_version)
+    
+    hierarchy = _LABEL_HIERARCHIES.get(key)
+    if hierarchy is None:
+        # Only keep the latest version of each pair of files in memory
+        paths = (hierarchy_version[0], descriptions_version and descriptions_version[0])
+        for old_key in [k for k in _LABEL_HIERARCHIES if (k[0][0], k[1] and k[1][0]) == paths]:
+            del _LABEL_HIERARCHIES[old_key]
+        hierarchy = LabelHierarchy.from_files(hierarchy_path, class_descriptions_path)
+        _LABEL_HIERARCHIES[key] = hierarchy
+    return hierarchy
+
+def clear_label_hierarchies():
+    """Release all memoized label hierarchies."""
+    _LABEL_HIERARCHIES.clear()
 
 def get_labels_by_subcategory(hierarchy_path, target_label_name):
     """
@@ -116,53 +554,7 @@ def get_labels_by_subcategory(hierarchy_path, target_label_name):
     list[str]
         List of all LabelNames that are subcategories under the target label
     """
-    with open(hierarchy_path, 'r') as f:
-        hierarchy = json.load(f)
-    
-    def find_entry(node, label_name):
-        """Recursively find an entry with the given label name."""
-        if isinstance(node, dict):
-            if node.get('LabelName') == label_name:
-                return node
-            # Search in subcategories
-            if 'Subcategory' in node:
-                for subcat in node['Subcategory']:
-                    result = find_entry(subcat, label_name)
-                    if result:
-                        return result
-        elif isinstance(node, list):
-            for item in node:
-                result = find_entry(item, label_name)
-                if result:
-                    return result
-        return None
-    
-    def collect_subcategories(node):
-        """Recursively collect all label names from subcategories."""
-        labels = []
-        if isinstance(node, dict):
-            # Add current label if it exists
-            if 'LabelName' in node:
-                labels.append(node['LabelName'])
-            # Recursively add subcategories
-            if 'Subcategory' in node:
-                for subcat in node['Subcategory']:
-                    labels.extend(collect_subcategories(subcat))
-        return labels
-    
-    # Find the target entry in the hierarchy
-    target_entry = find_entry(hierarchy, target_label_name)
-    
-    if not target_entry:
-        return []
-    
-    # Collect all subcategories (including the target label itself)
-    all_labels = [target_label_name]
-    if 'Subcategory' in target_entry:
-        for subcat in target_entry['Subcategory']:
-            all_labels.extend(collect_subcategories(subcat))
-    
-    return all_labels
+    return load_label_hierarchy(hierarchy_path).descendants(target_label_name)
 
 def get_vehicle_labels(hierarchy_path, class_descriptions_path):
     """
@@ -180,20 +572,143 @@ def get_vehicle_labels(hierarchy_path, class_descriptions_path):
     list[str]
         List of all LabelNames under the Vehicle category
     """
-    # Load class descriptions to find the Vehicle label ID
-    class_desc = load_class_descriptions(class_descriptions_path)
-    
-    # Find the label ID for "Vehicle"
-    vehicle_label_id = None
-    for label_id, display_name in class_desc.items():
-        if display_name == 'Vehicle':
-            vehicle_label_id = label_id
-            break
+    hierarchy = load_label_hierarchy(hierarchy_path, class_descriptions_path)
     
+    vehicle_label_id = hierarchy.label_for('Vehicle')
     if not vehicle_label_id:
         raise ValueError("Vehicle label not found in class descriptions")
     
-    return get_labels_by_subcategory(hierarchy_path, vehicle_label_id)
+    return hierarchy.descendants(vehicle_label_id)
+
+# Keyword arguments of filter_by_label_attributes and the columns they check
+ATTRIBUTE_COLUMNS = {
+    'is_occluded': 'IsOccluded',
+    'is_truncated': 'IsTruncated',
+    'is_group_of': 'IsGroupOf',
+    'is_depiction': 'IsDepiction',
+    'is_inside': 'IsInside',
+    'confidence': 'Confidence',
+}
+
+class AnnotationQuery:
+    """
+    Chain of per-image filters evaluated over a whole ImageIndex at once.
+    
+    Each step only updates a boolean mask over the rows of the shared table,
+    so a chain like ``labels(...).attributes(...)`` makes one pass per step
+    over flat NumPy columns and builds a single result at the end, instead
+    of one intermediate dict of DataFrames per filter. Steps are applied in
+    the order they are added, with the same semantics as calling the
+    matching filter_* functions one after another.
+    
+    Example:
+    --------
+    >>> AnnotationQuery(image_to_labels).labels(vehicle_labels).attributes(is_truncated=None).execute()
+    
+    Parameters:
+    -----------
+    image_to_labels : ImageIndex or dict[str, pd.DataFrame]
+        Annotations to filter
+    """
+    
+    def __init__(self, image_to_labels):
+        self.index = ImageIndex.from_mapping(image_to_labels)
+        self._steps = []
+    
+    def labels(self, allowed_labels, label_column='LabelName'):
+        """Keep only rows whose label is in allowed_labels (see filter_labels_by_category)."""
+        self._steps.append(lambda state: self._filter_labels(state, allowed_labels, label_column))
+        return self
+    
+    def attributes(self, is_occluded=0, is_truncated=0, is_group_of=0,
+                   is_depiction=0, is_inside=0, confidence=1):
+        """
+        Keep only images where all rows meet the attribute criteria
+        (see filter_by_label_attributes). A criterion of None is not checked.
+        """
+        criteria = {
+            ATTRIBUTE_COLUMNS['is_occluded']: is_occluded,
+            ATTRIBUTE_COLUMNS['is_truncated']: is_truncated,
+            ATTRIBUTE_COLUMNS['is_group_of']: is_group_of,
+            ATTRIBUTE_COLUMNS['is_depiction']: is_depiction,
+            ATTRIBUTE_COLUMNS['is_inside']: is_inside,
+            ATTRIBUTE_COLUMNS['confidence']: confidence,
+        }
+        criteria = {column: value for column, value in criteria.items() if value is not None}
+        self._steps.append(lambda state: self._filter_attributes(state, criteria))
+        return self
+    
+    def overlap(self, keep_overlapping=False, max_iou=None):
+        """
+        Keep images by bounding box overlap (see filter_by_bbox_overlap).
+        Only rows still kept by earlier steps are compared.
+        """
+        self._steps.append(lambda state: self._filter_overlap(state, keep_overlapping, max_iou))
+        return self
+    
+    def execute(self):
+        """
+        Run all steps and build the filtered index.
+        
+        Returns:
+        --------
+        ImageIndex
+            Filtered mapping from image IDs to DataFrames, excluding images
+            with no rows left
+        """
+        if len(self.index) == 0:
+            return self.index
+        state = _QueryState(self.index)
+        for step in self._steps:
+            step(state)
+        return self.index.take_rows(state.row_mask)
+    
+    def _filter_labels(self, state, allowed_labels, label_column):
+        state.row_mask &= self.index.df[label_column].isin(set(allowed_labels)).to_numpy()
+    
+    def _filter_attributes(self, state, criteria):
+        df = self.index.df
+        rows_ok = np.ones(len(df), dtype=bool)
+        for column, value in criteria.items():
+            rows_ok &= df[column].to_numpy() == value
+        state.drop_images(state.reduce_per_image(state.row_mask & ~rows_ok))
+
+    def _filter_overlap(self, state, keep_overlapping, max_iou):
+        live_rows = np.flatnonzero(state.row_mask)
+        counts = np.bincount(state.row_image[live_rows], minlength=len(self.index))
+        boxes = self.index.df[BOX_COLUMNS].to_numpy(dtype=np.float64)[live_rows]
+        overlap_count, image_max_iou = pairwise_overlap_stats(boxes, ImageIndex._offsets_from_counts(counts))
+        
+        if max_iou is not None:
+            state.drop_images(image_max_iou >= max_iou)
+        elif keep_overlapping:
+            state.drop_images(overlap_count == 0)
+        else:
+            state.drop_images(overlap_count > 0)
+
+class _QueryState:
+    """Row mask and row -> image bookkeeping shared by the steps of one AnnotationQuery run."""
+    
+    def __init__(self, index):
+        self.index = index
+        self.row_mask = np.ones(len(index.df), dtype=bool)
+        self._row_image = None
+    
+    @property
+    def row_image(self):
+        if self._row_image is None:
+            self._row_image = self.index.row_image_positions()
+        return self._row_image
+    
+    def reduce_per_image(self, row_flags):
+        """True for every image with at least one flagged row."""
+        if len(self.index) == 0:
+            return np.zeros(0, dtype=bool)
+        return np.logical_or.reduceat(row_flags, self.index.offsets[:-1])
+    
+    def drop_images(self, image_flags):
+        if image_flags.any():
+            self.row_mask &= ~image_flags[self.row_image]
 
 def filter_labels_by_category(image_to_labels, allowed_labels, label_column='LabelName'):
     """
@@ -211,21 +726,10 @@ def filter_labels_by_category(image_to_labels, allowed_labels, label_column='Lab
     
     Returns:
     --------
-    dict[str, pd.DataFrame]
-        Filtered dictionary with only allowed labels, excluding images with no labels
+    ImageIndex
+        Filtered mapping with only allowed labels, excluding images with no labels
     """
-    allowed_labels_set = set(allowed_labels)
-    filtered_dict = {}
-    
-    for image_id, df in image_to_labels.items():
-        # Filter to keep only rows with allowed labels
-        filtered_df = df[df[label_column].isin(allowed_labels_set)]
-        
-        # Only keep this image if it has at least one label after filtering
-        if len(filtered_df) > 0:
-            filtered_dict[image_id] = filtered_df
-    
-    return filtered_dict
+    return AnnotationQuery(image_to_labels).labels(allowed_labels, label_column).execute()
 
 def get_entry_count_distribution_from_dict(image_to_labels):
     """
@@ -243,6 +747,10 @@ def get_entry_count_distribution_from_dict(image_to_labels):
         Dictionary where keys are the number of entries (rows) for an image,
         and values are the occurrence count (how many images have that many entries)
     """
+    if isinstance(image_to_labels, ImageIndex):
+        values, occurrences = np.unique(image_to_labels.counts, return_counts=True)
+        return dict(zip(values.tolist(), occurrences.tolist()))
+    
     # Count entries for each image
     entry_counts = {image_id: len(df) for image_id, df in image_to_labels.items()}
     
@@ -284,27 +792,17 @@ def filter_by_label_attributes(image_to_labels,
     
     Returns:
     --------
-    dict[str, pd.DataFrame]
-        Filtered dictionary containing only images where all labels meet the criteria
-    """
-    filtered_dict = {}
-    
-    for image_id, df in image_to_labels.items():
-        # Check if ALL labels in this image meet the criteria
-        all_conditions_met = (
-            (df['IsOccluded'] == is_occluded).all() and
-            (df['IsTruncated'] == is_truncated).all() and
-            (df['IsGroupOf'] == is_group_of).all() and
-            (df['IsDepiction'] == is_depiction).all() and
-            (df['IsInside'] == is_inside).all() and
-            (df['Confidence'] == confidence).all()
-        )
-        
-        # Only keep the image if all labels meet the criteria
-        if all_conditions_met:
-            filtered_dict[image_id] = df
-    
-    return filtered_dict
+    ImageIndex
+        Filtered mapping containing only images where all labels meet the criteria
+    """
+    return AnnotationQuery(image_to_labels).attributes(
+        is_occluded=is_occluded,
+        is_truncated=is_truncated,
+        is_group_of=is_group_of,
+        is_depiction=is_depiction,
+        is_inside=is_inside,
+        confidence=confidence,
+    ).execute()
 
 def bboxes_overlap(bbox1, bbox2):
     """
@@ -331,7 +829,98 @@ def bboxes_overlap(bbox1, bbox2):
     
     return horizontal_overlap and vertical_overlap
 
-def filter_by_bbox_overlap(image_to_labels, keep_overlapping=False):
+BOX_COLUMNS = ['XMin', 'XMax', 'YMin', 'YMax']
+
+def pairwise_overlap_stats(boxes, offsets, max_broadcast_size=32):
+    """
+    Count overlapping box pairs and find the largest pairwise IoU per image.
+    
+    Overlap uses the same strict test as bboxes_overlap. Images with at most
+    max_broadcast_size boxes are compared all-pairs at once with NumPy
+    broadcasting, batched by box count. Larger images are sorted by XMin and
+    only pairs whose x-ranges can intersect are generated (sweep along x).
+    
+    Parameters:
+    -----------
+    boxes : numpy.ndarray
+        (N, 4) array of (xmin, xmax, ymin, ymax), grouped by image
+    offsets : numpy.ndarray of int
+        Group boundaries into boxes, of length n_images + 1
+    max_broadcast_size : int, default=32
+        Largest image (in boxes) handled by the broadcasting path
+    
+    Returns:
+    --------
+    tuple[numpy.ndarray, numpy.ndarray]
+        Number of overlapping pairs (int64) and maximum IoU (float64, 0 when
+        nothing overlaps) for each image
+    """
+    sizes = np.diff(offsets)
+    overlap_count = np.zeros(len(sizes), dtype=np.int64)
+    max_iou = np.zeros(len(sizes), dtype=np.float64)
+    
+    for size in np.unique(sizes[(sizes > 1) & (sizes <= max_broadcast_size)]):
+        images = np.flatnonzero(sizes == size)
+        # Keep the (images, size, size) temporaries at a few million elements
+        batch = max(1, 4_000_000 // (size * size))
+        upper = np.triu(np.ones((size, size), dtype=bool), k=1)
+        for i in range(0, len(images), batch):
+            chunk = images[i:i + batch]
+            group = boxes[offsets[chunk][:, None] + np.arange(size)]
+            a, b = group[:, :, None, :], group[:, None, :, :]
+            overlaps, iou = _overlap_and_iou(a, b)
+            overlap_count[chunk] = (overlaps & upper).sum(axis=(1, 2))
+            max_iou[chunk] = np.where(upper, iou, 0.0).max(axis=(1, 2))
+    
+    for image in np.flatnonzero(sizes > max_broadcast_size):
+        group = boxes[offsets[image]:offsets[image + 1]]
+        group = group[np.argsort(group[:, 0], kind='stable')]
+        # Candidates for box i are the boxes after it that start before it ends
+        ends = np.searchsorted(group[:, 0], group[:, 1], side='left')
+        n_candidates = np.maximum(ends - np.arange(1, len(group) + 1), 0)
+        first = np.repeat(np.arange(len(group)), n_candidates)
+        second = first + 1 + np.arange(len(first)) - np.repeat(np.cumsum(n_candidates) - n_candidates, n_candidates)
+        overlaps, iou = _overlap_and_iou(group[first], group[second])
+        overlap_count[image] = overlaps.sum()
+        max_iou[image] = iou.max(initial=0.0)
+    
+    return overlap_count, max_iou
+
+def _overlap_and_iou(a, b):
+    """Elementwise bboxes_overlap and IoU for broadcastable (..., 4) box arrays."""
+    xmin1, xmax1, ymin1, ymax1 = np.moveaxis(a, -1, 0)
+    xmin2, xmax2, ymin2, ymax2 = np.moveaxis(b, -1, 0)
+    overlaps = (xmin1 < xmax2) & (xmax1 > xmin2) & (ymin1 < ymax2) & (ymax1 > ymin2)
+    
+    inter_w = np.minimum(xmax1, xmax2) - np.maximum(xmin1, xmin2)
+    inter_h = np.minimum(ymax1, ymax2) - np.maximum(ymin1, ymin2)
+    intersection = np.where(overlaps, inter_w * inter_h, 0.0)
+    union = (xmax1 - xmin1) * (ymax1 - ymin1) + (xmax2 - xmin2) * (ymax2 - ymin2) - intersection
+    with np.errstate(divide='ignore', invalid='ignore'):
+        iou = np.where(union > 0, intersection / union, 0.0)
+    return overlaps, iou
+
+def bbox_overlap_stats(image_to_labels):
+    """
+    Get per-image bounding box overlap statistics.
+    
+    Parameters:
+    -----------
+    image_to_labels : dict[str, pd.DataFrame]
+        Dictionary mapping image IDs to DataFrames containing labels
+    
+    Returns:
+    --------
+    pd.DataFrame
+        Indexed by image ID, with columns 'overlap_count' (number of
+        overlapping box pairs) and 'max_iou' (largest pairwise IoU)
+    """
+    index = ImageIndex.from_mapping(image_to_labels)
+    boxes = index.df[BOX_COLUMNS].to_numpy(dtype=np.float64) if len(index) else np.zeros((0, 4))
+    overlap_count, max_iou = pairwise_overlap_stats(boxes, index.offsets)
+    return pd.DataFrame({'overlap_count': overlap_count, 'max_iou': max_iou}, index=index.image_ids)
+
+def filter_by_bbox_overlap(image_to_labels, keep_overlapping=False, max_iou=None):
     """
     Filter images based on whether their bounding boxes overlap.
     
@@ -342,40 +931,261 @@ def filter_by_bbox_overlap(image_to_labels, keep_overlapping=False):
     keep_overlapping : bool, default=False
         If False, keep only images WITHOUT any overlapping bounding boxes.
         If True, keep only images WITH at least one overlapping pair.
+    max_iou : float, optional
+        If given, keep only images whose largest pairwise IoU is below this
+        value instead, ignoring keep_overlapping.
     
     Returns:
     --------
-    dict[str, pd.DataFrame]
-        Filtered dictionary based on bounding box overlap criteria
+    ImageIndex
+        Filtered mapping based on bounding box overlap criteria
+    """
+    return AnnotationQuery(image_to_labels).overlap(keep_overlapping, max_iou).execute()
+
+def filter_annotations(image_to_labels, allowed_labels=None, attributes=None, overlap=None):
     """
-    filtered_dict = {}
+    Run the category -> attribute -> overlap filter chain as one query.
     
-    for image_id, df in image_to_labels.items():
-        has_overlap = False
-        
-        # Check all pairs of bounding boxes in this image
-        if len(df) > 1:
-            bboxes = df[['XMin', 'XMax', 'YMin', 'YMax']].values
+    Equivalent to calling filter_labels_by_category, filter_by_label_attributes
+    and filter_by_bbox_overlap in that order, skipping steps set to None.
+    
+    Parameters:
+    -----------
+    image_to_labels : dict[str, pd.DataFrame]
+        Dictionary mapping image IDs to DataFrames containing labels
+    allowed_labels : list[str], optional
+        Label names to keep
+    attributes : dict, optional
+        Keyword arguments for filter_by_label_attributes
+    overlap : dict, optional
+        Keyword arguments for filter_by_bbox_overlap
+    
+    Returns:
+    --------
+    ImageIndex
+        Filtered mapping
+    """
+    query = AnnotationQuery(image_to_labels)
+    if allowed_labels is not None:
+        query.labels(allowed_labels)
+    if attributes is not None:
+        query.attributes(**attributes)
+    if overlap is not None:
+        query.overlap(**overlap)
+    return query.execute()
+
+def filter_csv_to_yolo(csv_path, output_dir, label_to_class_id, allowed_labels=None, attributes=None,
+                       overlap=None, chunksize=None, precision=6, image_id_column='ImageID', num_workers=1):
+    """
+    Filter an annotation CSV and write the remaining images as YOLO label files.
+    
+    By default the whole CSV is loaded through load_annotation_table. With
+    chunksize set, the CSV is instead read in chunks of about that many rows,
+    cut at image boundaries, and each chunk is filtered and written before
+    the next one is read, so peak memory is bounded by the chunk size rather
+    than the dataset size. Every filter only looks at the rows of one image,
+    so both modes write identical files. Streaming requires the CSV to be
+    sorted by image ID, as the Open Images CSVs are.
+    
+    Parameters:
+    -----------
+    csv_path : str or Path
+        Path to the annotation CSV file
+    output_dir : str or Path
+        Directory to write label files to
+    label_to_class_id : dict[str, int]
+        Dictionary mapping LabelName to class_id (integer)
+    allowed_labels, attributes, overlap
+        Filter chain settings, see filter_annotations
+    chunksize : int, optional
+        Rows per chunk in streaming mode; None loads the whole CSV
+    precision : int, default=6
+        Number of decimals written for coordinates
+    image_id_column : str, default='ImageID'
+        Name of the column containing image IDs
+    num_workers : int, default=1
+        Number of processes; more than one runs each table (or chunk)
+        through parallel_filter_to_yolo
+    
+    Returns:
+    --------
+    int
+        Number of label files written
+    """
+    def export(image_to_labels):
+        if num_workers > 1:
+            return parallel_filter_to_yolo(image_to_labels, output_dir, label_to_class_id, allowed_labels,
+                                           attributes, overlap, num_workers=num_workers, precision=precision)
+        filtered = filter_annotations(image_to_labels, allowed_labels, attributes, overlap)
+        return write_yolo_labels(filtered, label_to_class_id, output_dir, precision=precision)
+    
+    if chunksize is None:
+        return export(get_dataframes_by_image_id(csv_path, image_id_column))
+    
+    written = 0
+    for chunk in iter_image_chunks(csv_path, chunksize, image_id_column):
+        written += export(ImageIndex.from_dataframe(chunk, image_id_column))
+    if written == 0:
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
+    return written
+
+def parallel_filter_to_yolo(image_to_labels, output_dir, label_to_class_id, allowed_labels=None,
+                            attributes=None, overlap=None, num_workers=None, precision=6, shards_per_worker=4):
+    """
+    Run filter_annotations and write_yolo_labels on all cores.
+    
+    The columns the filters need are copied once into shared memory. Each
+    worker process attaches to them, takes a contiguous shard of images and
+    filters and writes it independently, so no DataFrames are pickled.
+    Every image is written to its own file by exactly one shard, so the
+    output is identical to the serial run regardless of scheduling.
+    
+    Parameters:
+    -----------
+    image_to_labels : dict[str, pd.DataFrame]
+        Dictionary mapping image IDs to DataFrames containing labels
+    output_dir : str or Path
+        Directory to write label files to
+    label_to_class_id : dict[str, int]
+        Dictionary mapping LabelName to class_id (integer)
+    allowed_labels, attributes, overlap
+        Filter chain settings, see filter_annotations
+    num_workers : int, optional
+        Number of worker processes, defaults to the number of CPUs
+    precision : int, default=6
+        Number of decimals written for coordinates
+    shards_per_worker : int, default=4
+        Shards per worker, for load balancing across uneven images
+    
+    Returns:
+    --------
+    int
+        Number of label files written
+    """
+    index = ImageIndex.from_mapping(image_to_labels)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if len(index) == 0:
+        return 0
+    
+    num_workers = num_workers or os.cpu_count()
+    columns = ['LabelName', *BOX_COLUMNS, *(c for c in ATTRIBUTE_COLUMNS.values() if c in index.df.columns)]
+    filters = (allowed_labels, attributes, overlap)
+    
+    # Shard boundaries at image starts, with roughly equal row counts
+    n_shards = min(len(index), num_workers * shards_per_worker)
+    row_targets = np.linspace(0, index.offsets[-1], n_shards + 1)[1:-1]
+    bounds = np.unique(np.concatenate(([0], np.searchsorted(index.offsets, row_targets), [len(index)])))
+    
+    shared = _SharedColumns(index.df[columns])
+    try:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = [
+                executor.submit(
+                    _filter_shard, shared.spec, list(index.image_ids[start:stop]), index.offsets[start:stop + 1],
+                    output_dir, label_to_class_id, filters, precision,
+                )
+                for start, stop in zip(bounds[:-1], bounds[1:])
+            ]
+            return sum(future.result() for future in futures)
+    finally:
+        shared.release()
+
+class _SharedColumns:
+    """Copy of DataFrame columns in shared memory, categoricals stored as codes."""
+    
+    def __init__(self, df):
+        self.spec = {}
+        self._blocks = []
+        try:
+            for column in df.columns:
+                values, categories = df[column], None
+                if isinstance(values.dtype, pd.CategoricalDtype):
+                    values, categories = values.cat.codes, list(values.cat.categories)
+                elif values.dtype.kind not in 'biuf':
+                    values, categories = pd.factorize(values)
+                    categories = list(categories)
+                values = np.ascontiguousarray(values)
+                
+                block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+                self._blocks.append(block)
+                np.ndarray(values.shape, values.dtype, buffer=block.buf)[:] = values
+                self.spec[column] = (block.name, values.dtype.str, len(values), categories)
+        except BaseException:
+            self.release()
+            raise
+    
+    def release(self):
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+def _read_shared_rows(spec, row_start, row_stop):
+    """Rebuild rows [row_start, row_stop) of a _SharedColumns table as a DataFrame."""
+    data = {}
+    for column, (name, dtype, length, categories) in spec.items():
+        block = shared_memory.SharedMemory(name=name)
+        try:
+            values = np.ndarray((length,), np.dtype(dtype), buffer=block.buf)[row_start:row_stop].copy()
+        finally:
+            block.close()
+        data[column] = values if categories is None else pd.Categorical.from_codes(values, categories)
+    return pd.DataFrame(data)
+
+def _filter_shard(spec, image_ids, offsets, output_dir, label_to_class_id, filters, precision):
+    df = _read_shared_rows(spec, offsets[0], offsets[-1])
+    df.index = pd.RangeIndex(offsets[0], offsets[-1])
+    shard = ImageIndex(df, image_ids, offsets - offsets[0])
+    filtered = filter_annotations(shard, *filters)
+    return write_yolo_labels(filtered, label_to_class_id, output_dir, precision=precision)
+
+def iter_image_chunks(csv_path, chunksize, image_id_column='ImageID'):
+    """
+    Read an annotation CSV in chunks that never split the rows of an image.
+    
+    Parameters:
+    -----------
+    csv_path : str or Path
+        Path to the CSV file, sorted by image ID
+    chunksize : int
+        Approximate number of rows per chunk
+    image_id_column : str, default='ImageID'
+        Name of the column containing image IDs
+    
+    Yields:
+    -------
+    pd.DataFrame
+        Consecutive chunks holding all rows of the images they contain
+    
+    Raises:
+    -------
+    ValueError
+        If the CSV is not sorted by image ID
+    """
+    header = pd.read_csv(csv_path, nrows=0).columns
+    dtypes = {col: dtype for col, dtype in ANNOTATION_DTYPES.items() if col in header}
+    # Categories would differ from chunk to chunk, keep IDs as plain strings
+    dtypes[image_id_column] = str
+    
+    carry = None
+    # Closed on errors and when the caller stops iterating early
+    with pd.read_csv(csv_path, dtype=dtypes, chunksize=chunksize) as reader:
+        for chunk in reader:
+            if carry is not None:
+                chunk = pd.concat([carry, chunk])
+            image_ids = chunk[image_id_column]
+            if not image_ids.is_monotonic_increasing:
+                raise ValueError(f"{csv_path} must be sorted by {image_id_column} to be read in chunks")
             
-            for i in range(len(bboxes)):
-                for j in range(i + 1, len(bboxes)):
-                    if bboxes_overlap(bboxes[i], bboxes[j]):
-                        has_overlap = True
-                        break
-                if has_overlap:
-                    break
-        
-        # Keep image based on overlap status and filter criteria
-        if keep_overlapping:
-            # Keep only images WITH overlaps
-            if has_overlap:
-                filtered_dict[image_id] = df
-        else:
-            # Keep only images WITHOUT overlaps
-            if not has_overlap:
-                filtered_dict[image_id] = df
+            # The last image may continue in the next chunk, hold it back
+            is_last_image = (image_ids == image_ids.iloc[-1]).to_numpy()
+            carry = chunk[is_last_image]
+            if not is_last_image.all():
+                yield chunk[~is_last_image]
     
-    return filtered_dict
+    if carry is not None:
+        yield carry
 
 def create_label_to_class_id_mapping(labels):
     """
@@ -393,7 +1203,7 @@ def create_label_to_class_id_mapping(labels):
     """
     return {label: idx for idx, label in enumerate(labels)}
 
-def convert_to_yolo_format(image_to_labels, label_to_class_id):
+def convert_to_yolo_format(image_to_labels, label_to_class_id, precision=6):
     """
     Convert bounding boxes from (XMin, XMax, YMin, YMax) to YOLO format.
     YOLO format: class_id x_center y_center width height (all normalized 0-1)
@@ -404,6 +1214,8 @@ def convert_to_yolo_format(image_to_labels, label_to_class_id):
         Dictionary mapping image IDs to DataFrames containing labels
     label_to_class_id : dict[str, int]
         Dictionary mapping LabelName to class_id (integer)
+    precision : int, default=6
+        Number of decimals written for coordinates
     
     Returns:
     --------
@@ -412,32 +1224,131 @@ def convert_to_yolo_format(image_to_labels, label_to_class_id):
         Each string contains one line per label in format:
         "class_id x_center y_center width height"
     """
-    yolo_labels = {}
+    return dict(iter_yolo_labels(image_to_labels, label_to_class_id, precision))
+
+def iter_yolo_labels(image_to_labels, label_to_class_id, precision=6, rows_per_batch=200_000):
+    """
+    Yield (image_id, YOLO label string) pairs, computed batch-wise.
     
-    for image_id, df in image_to_labels.items():
-        lines = []
-        
-        for _, row in df.iterrows():
-            # Get the class ID for this label
-            label_name = row['LabelName']
-            if label_name not in label_to_class_id:
-                # Skip labels without a class ID mapping
-                continue
-            
-            class_id = label_to_class_id[label_name]
-            
-            # Convert to YOLO format
-            x_center = (row['XMin'] + row['XMax']) / 2
-            y_center = (row['YMin'] + row['YMax']) / 2
-            width = row['XMax'] - row['XMin']
-            height = row['YMax'] - row['YMin']
-            
-            # Format as string
-            line = f"{class_id} {x_center} {y_center} {width} {height}"
-            lines.append(line)
-        
-        # Join all lines for this image
-        if lines:  # Only add if there are valid labels
-            yolo_labels[image_id] = '\n'.join(lines)
+    Centers and sizes are computed for a whole batch of rows at once and
+    LabelName is mapped to class IDs through its categories. Rows whose label
+    has no class ID are skipped, and images left without rows are not
+    yielded, as in convert_to_yolo_format.
+    
+    Parameters:
+    -----------
+    image_to_labels : dict[str, pd.DataFrame]
+        Dictionary mapping image IDs to DataFrames containing labels
+    label_to_class_id : dict[str, int]
+        Dictionary mapping LabelName to class_id (integer)
+    precision : int, default=6
+        Number of decimals written for coordinates
+    rows_per_batch : int, default=200_000
+        Approximate number of rows formatted at a time, bounding the number
+        of line strings held in memory
+    
+    Yields:
+    -------
+    tuple[str, str]
+        Image ID and its label lines joined by newlines
+    """
+    index = ImageIndex.from_mapping(image_to_labels)
+    if len(index) == 0:
+        return
+    
+    df = index.df
+    class_ids = _map_class_ids(df['LabelName'], label_to_class_id)
+    xmin, xmax, ymin, ymax = df[BOX_COLUMNS].to_numpy(dtype=np.float64).T
+    x_center = (xmin + xmax) / 2
+    y_center = (ymin + ymax) / 2
+    width = xmax - xmin
+    height = ymax - ymin
+    
+    line_format = f"%d %.{precision}f %.{precision}f %.{precision}f %.{precision}f"
+    offsets = index.offsets
+    batch_starts = np.searchsorted(offsets, np.arange(0, offsets[-1], rows_per_batch), side='right') - 1
+    batch_bounds = list(np.unique(batch_starts)) + [len(index)]
+    
+    for first_image, end_image in zip(batch_bounds[:-1], batch_bounds[1:]):
+        row_start, row_stop = offsets[first_image], offsets[end_image]
+        rows = np.flatnonzero(class_ids[row_start:row_stop] >= 0) + row_start
+        lines = [
+            line_format % values
+            for values in zip(class_ids[rows].tolist(), x_center[rows].tolist(), y_center[rows].tolist(),
+                              width[rows].tolist(), height[rows].tolist())
+        ]
+        # Line range of every image in this batch
+        line_offsets = np.searchsorted(rows, offsets[first_image:end_image + 1], side='left')
+        for i, image_id in enumerate(index.image_ids[first_image:end_image]):
+            if line_offsets[i + 1] > line_offsets[i]:
+                yield image_id, '\n'.join(lines[line_offsets[i]:line_offsets[i + 1]])
+
+def _map_class_ids(labels, label_to_class_id):
+    """Map a LabelName column to an int array of class IDs, -1 where unmapped."""
+    if isinstance(labels.dtype, pd.CategoricalDtype):
+        category_ids = np.array([label_to_class_id.get(label, -1) for label in labels.cat.categories], dtype=np.int64)
+        codes = labels.cat.codes.to_numpy()
+        return np.where(codes >= 0, category_ids[codes], -1)
+    return labels.map(label_to_class_id).fillna(-1).to_numpy(dtype=np.int64)
+
+def write_yolo_labels(image_to_labels, label_to_class_id, output_dir, precision=6,
+                      num_workers=1, files_per_batch=1000):
+    """
+    Write one YOLO label file per image, streaming from iter_yolo_labels.
+    
+    Files are named ``{image_id}.txt`` and hold the same text as the values
+    returned by convert_to_yolo_format.
+    
+    Parameters:
+    -----------
+    image_to_labels : dict[str, pd.DataFrame]
+        Dictionary mapping image IDs to DataFrames containing labels
+    label_to_class_id : dict[str, int]
+        Dictionary mapping LabelName to class_id (integer)
+    output_dir : str or Path
+        Directory to write label files to, created if missing
+    precision : int, default=6
+        Number of decimals written for coordinates
+    num_workers : int, default=1
+        Number of threads writing batches of files in parallel
+    files_per_batch : int, default=1000
+        Number of files handed to a writer thread at a time
     
-    return yolo_labels
+    Returns:
+    --------
+    int
+        Number of files written
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    
+    def batches():
+        batch = []
+        for item in iter_yolo_labels(image_to_labels, label_to_class_id, precision):
+            batch.append(item)
+            if len(batch) == files_per_batch:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    
+    if num_workers <= 1:
+        return sum(_write_label_files(output_dir, batch) for batch in batches())
+    
+    written = 0
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        # Bound the number of formatted batches waiting to be written
+        pending = deque()
+        for batch in batches():
+            if len(pending) >= 2 * num_workers:
+                written += pending.popleft().result()
+            pending.append(executor.submit(_write_label_files, output_dir, batch))
+        while pending:
+            written += pending.popleft().result()
+    return written
+
+def _write_label_files(output_dir, items):
+    for image_id, text in items:
+        with open(output_dir / f"{image_id}.txt", 'w') as f:
+            f.write(text)
+    return len(items)